@@ -1,122 +1,338 @@
 from __future__ import division
-from random import randrange, randint, random
-from collections import defaultdict
+from collections import namedtuple
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+import logging
+import time
 
 import numpy     as np
 import itertools as it
 
+from clustering.kernels import pairwise_kernel, kernel_diagonal, get_kernel
+from clustering.quality import davies_bouldin_index
+from util.persistence import save_arrays, load_arrays
+
+logger = logging.getLogger(__name__)
+
+IterationRecord = namedtuple("IterationRecord", ['iteration', 'elapsed', 'changed', 'inertia'])
+
 
 class KMeansKernel:
     """
     Batch kmeans clustering of a set of vectors using
-    a linear kernel as measure of distance metric.
+    a kernel as measure of distance metric.
     
     :param num_clusters   : number of clusters to compute 
     :param num_iterations : number of iterations to perform 
     :param initialization : cluster initialization algorithm to use defaults to 
-                            "random", using kmeans++ is recommended
+                            "random", using kmeans++ is recommended, kmeans||
+                            samples the candidates in a few rounds for large data
+    :param kernel         : kernel to use, one of "linear", "rbf", "polynomial",
+                            "cosine", a kernel registered with
+                            clustering.kernels.register_kernel, a kernel function
+                            or "precomputed" to pass the kernel matrix as X
+    :param kernel_params  : dict of parameters for the kernel function
+    :param approximation  : None to cluster with the exact kernel matrix or
+                            "nystroem" to cluster in a low rank feature space
+                            built from num_landmarks points, taking O(n * m)
+                            memory instead of O(n * n)
+    :param num_landmarks  : number of landmark points of the nystroem approximation
+    :param n_jobs         : number of threads computing the assignment step over
+                            chunks of points, -1 to use all the cores
+    :param chunk_size     : number of points in a chunk
+    :param tolerance      : optional relative decrease of the inertia (sum of the
+                            distances of the points to their clusters) below which
+                            the clustering is considered converged
+    :param callback       : optional function called with the IterationRecord
+                            (iteration, elapsed seconds, number of points that
+                            changed cluster, inertia) of every iteration of fit
+    :param compute_quality: compute the Davies-Bouldin index of the clustering at
+                            the end of fit, see clustering.quality
     """
 
     def __init__(self, num_clusters=2, num_iterations=100, \
-                 initialization='random'):
+                 initialization='random', kernel='linear', kernel_params=None,
+                 approximation=None, num_landmarks=100, n_jobs=1, chunk_size=1024,
+                 tolerance=None, callback=None, compute_quality=False):
         self.num_clusters = num_clusters
         self.num_iterations = num_iterations
         self.epsilon = 1e-15
-        print "value of eps :: ", self.epsilon
-        assert (initialization == "random" or initialization == "kmeans++"), \
+        logger.debug("value of eps :: %g", self.epsilon)
+        assert initialization in ("random", "kmeans++", "kmeans||"), \
             "Unknown initialization scheme"
         self.initialization = initialization
+        if kernel != 'precomputed':
+            get_kernel(kernel)
+        self.kernel = kernel
+        self.kernel_params = kernel_params or {}
+        assert (approximation is None or approximation == "nystroem"), \
+            "Unknown approximation scheme"
+        assert not (approximation and kernel == 'precomputed'), \
+            "nystroem approximation needs the data points, not a precomputed kernel"
+        self.approximation = approximation
+        self.num_landmarks = num_landmarks
+        self.n_jobs = cpu_count() if n_jobs == -1 else n_jobs
+        self.chunk_size = chunk_size
+        self.tolerance = tolerance
+        self.callback = callback
+        self.compute_quality = compute_quality
+        # whether the clusters are held as explicit sums of feature vectors
+        self._feature_space = False
+        # number of points of each cluster, None until the model is fitted
+        self._counts = None
+
+    def __fit_feature_map(self, X):
+        """
+        build the nystroem feature map phi(x) = k(x, L) * K(L, L)^(-1/2) from
+        a random sample of landmark points L of X, so that <phi(x), phi(y)>
+        approximates k(x, y)
+        :param X : (num_samples, num_features) numpy ndarray
+        """
+        num_landmarks = min(self.num_landmarks, X.shape[0])
+        landmark_indices = np.random.choice(X.shape[0], num_landmarks, replace=False)
+        self._landmarks = X[landmark_indices]
+        landmark_gram = pairwise_kernel(self._landmarks, kernel=self.kernel, **self.kernel_params)
+
+        # drop the directions of the (numerically) singular eigenvalues
+        eigen_values, eigen_vectors = np.linalg.eigh(landmark_gram)
+        keep = eigen_values > self.epsilon * max(np.max(eigen_values), self.epsilon)
+        self._feature_map = eigen_vectors[:, keep] / np.sqrt(eigen_values[keep])
 
-    def _cluster_compactness(self, ci, refresh=False, cj=None):
+    def __features(self, X):
         """
-        compute the cluster compactness of the ith cluster 
-        :param ci : cluster label 
-        :param cj : optional cluster label, if specified 
-                    the compactness measure of two clusters combined will be
-                    computed, refresh will be ignored 
-        :param refresh : ignore the memoized value and compute the 
-                         new fresh value
+        map the points X to the nystroem feature space
+        :param X : (num_points, num_features) numpy ndarray
+        :return : (num_points, num_components) numpy ndarray
         """
-        try:
-            self._compactness
-        except AttributeError, e:
-            self._compactness = dict()
+        return np.dot(pairwise_kernel(X, self._landmarks, kernel=self.kernel, **self.kernel_params),
+                      self._feature_map)
+
+    def __map_features(self, X):
+        """
+        map the points X to the explicit feature space the clusters are held in,
+        the nystroem feature space or the input space itself for the linear kernel
+        """
+        return self.__features(X) if self.approximation == "nystroem" else X
+
+    def __pool(self, num_rows):
+        """
+        create the pool of threads the chunks of num_rows rows run on, one pool
+        is shared by every chunked step of a fit or predict call
+        :param num_rows : number of rows the chunked steps work on
+        :return : ThreadPool, None if the chunks run serially
+        """
+        num_chunks = -(-num_rows // self.chunk_size)
+        if self.n_jobs <= 1 or num_chunks <= 1:
+            return None
+        return ThreadPool(min(self.n_jobs, num_chunks))
 
-        if cj:
-            refresh = True
+    def __close_pool(self, pool):
+        """
+        close the pool from __pool and wait for its threads to exit
+        """
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def __map_chunks(self, func, num_rows, pool=None):
+        """
+        apply func on consecutive chunks of rows, with a pool the chunks run on
+        its threads, which share the arrays func reads and writes instead of
+        copying them to workers, numpy releases the GIL in the matrix products
+        :param func : function of type f(start, stop) working on rows [start, stop)
+        :param num_rows : total number of rows
+        :param pool : ThreadPool from __pool, None to run the chunks serially
+        :return : list of the results of func on each chunk
+        """
+        chunks = [(start, min(start + self.chunk_size, num_rows))
+                  for start in xrange(0, num_rows, self.chunk_size)]
+        if pool is None or len(chunks) <= 1:
+            return [func(start, stop) for (start, stop) in chunks]
+        return pool.map(lambda chunk: func(*chunk), chunks)
+
+    def __cluster_counts(self, labels):
+        """
+        count the points in each cluster, points labelled -1 are in no cluster
+        :param labels : integer array of cluster label of each point
+        """
+        return np.bincount(labels[labels >= 0], minlength=self.num_clusters).astype(np.float64)
+
+    def __cluster_sums(self, values, labels):
+        """
+        sum the rows of values per cluster, one bincount pass per column,
+        points labelled -1 are in no cluster
+        :param values : (num_points, num_columns) numpy ndarray
+        :param labels : integer array of cluster label of each point
+        :return : (num_clusters, num_columns) numpy ndarray
+        """
+        assigned = labels >= 0
+        labels, values = labels[assigned], values[assigned]
+        sums = np.empty(shape=(self.num_clusters, values.shape[1]))
+        for column in xrange(values.shape[1]):
+            sums[:, column] = np.bincount(labels, weights=values[:, column], minlength=self.num_clusters)
+        return sums
+
+    def __cluster_terms(self, labels, pool=None):
+        """
+        compute the per cluster terms of the kernelized distance for a
+        labelling of the training set
+        :param labels : integer array of cluster label of each sample, -1 for
+                        samples in no cluster
+        :param pool : ThreadPool the chunks run on, None to run them serially
+        :return : (gram_indicator, cluster sizes, cluster compactness) where
+                  gram_indicator is the product of the gram matrix with the
+                  label indicator matrix and the compactness of cluster c is the
+                  mean kernel value over all pairs of points in c
+        """
+        gram_indicator = np.empty(shape=(self.num_samples, self.num_clusters))
+        counts = self.__cluster_counts(labels)
+        if self._features is None:
+            indicator = self.__indicator(labels)
+
+            def product(start, stop):
+                gram_indicator[start:stop] = np.dot(self._gram[start:stop], indicator)
+            self.__map_chunks(product, self.num_samples, pool)
+            cluster_products = np.sum(indicator * gram_indicator, axis=0)
         else:
-            cj = ci
+            # the gram matrix of the feature space is never formed, the product
+            # goes through the per cluster sums of the features instead
+            self._feature_sums = self.__cluster_sums(self._features, labels)
 
-        if not refresh and self._compactness.has_key(ci):
-            return self._compactness[ci]
+            def product(start, stop):
+                gram_indicator[start:stop] = np.dot(self._features[start:stop], self._feature_sums.T)
+            self.__map_chunks(product, self.num_samples, pool)
+            cluster_products = np.sum(self._feature_sums * self._feature_sums, axis=1)
 
-        num_ci = len(self._clusters_old[ci])
-        num_cj = len(self._clusters_old[cj])
-        # no points assigned to this cluster return 0 as measure of compactness
-        if num_ci == 0 or num_cj == 0:
-            if num_ci == 0: self._compactness[ci] = 0
-            if num_cj == 0: self._compactness[cj] = 0
-            return 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            compactness = cluster_products / (counts * counts)
+        return gram_indicator, counts, compactness
 
-        mc = 0
-        for i, ai in self._clusters_old[ci]:
-            for j, aj in self._clusters_old[cj]:
-                mc += np.dot(ai, aj)
+    def __distances(self, kernel_indicator, kernel_diag, counts, compactness):
+        """
+        compute the kernelized distance between a set of points and every cluster
+        :param kernel_indicator : (num_points, num_clusters) product of the kernel rows
+                                  of the points against the training set with the
+                                  label indicator matrix
+        :param kernel_diag : (num_points,) kernel value of each point with itself
+        :param counts : (num_clusters,) number of points in each cluster
+        :param compactness : (num_clusters,) compactness of each cluster
+        :return : (num_points, num_clusters) matrix of distances, clusters
+                  with no points assigned are at infinite distance
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            distances = kernel_diag[:, None] - 2 * kernel_indicator / counts + compactness
+        distances[:, counts == 0] = np.inf
+        return distances
 
-        mc = mc / (num_ci * num_cj)
-        # cache only if cj is not specified 
-        if cj == ci: self._compactness[ci] = mc
-        return mc
+    def __indicator(self, labels):
+        """
+        build the (num_samples, num_clusters) label indicator matrix
+        :param labels : integer array of cluster label of each sample, samples
+                        labelled -1 are in no cluster
+        """
+        indicator = np.zeros(shape=(len(labels), self.num_clusters))
+        assigned = np.flatnonzero(labels >= 0)
+        indicator[assigned, labels[assigned]] = 1
+        return indicator
 
-    def __centroid_distance(self, ci, cj):
+    def __point_distances(self, indices):
         """
-        compute the kernelized distance between centroids of 
-        cluster center ci and cj
-        :param ci : cluster label for ith cluster
-        :param cj : cluster label for jth cluster
+        compute the squared kernelized distance of every training point to
+        each of the training points at indices
+        :param indices : integer array of training point indices
+        :return : (len(indices), num_samples) matrix of squared distances
         """
-        return np.power(self._cluster_compactness(ci), 2) + np.power \
-            (self._cluster_compactness(cj), 2) - 2 * self._cluster_compactness(ci, cj)
+        if self._features is None:
+            products = self._gram[indices]
+        else:
+            products = np.dot(self._features[indices], self._features.T)
+        distances = self._gram_diag[None, :] - 2 * products + self._gram_diag[indices][:, None]
+        return np.maximum(distances, 0, out=distances)
 
-    def __distance(self, x, ci):
+    def __sample(self, weights, chosen=()):
+        """
+        sample an index with probability proportional to its weight, a uniformly
+        random index not chosen yet if all the weights are zero
+        :param weights : array of non negative weights
+        :param chosen : indices chosen before
         """
-        compute the kernelized distance between vector x and a cluster center ci
-        :param x : datapoint vector
-        :param ci : the cluster label for the ith cluster
+        cumulative = np.cumsum(weights)
+        if cumulative[-1] <= 0:
+            unchosen = np.setdiff1d(np.arange(len(weights)), chosen)
+            return np.random.choice(unchosen) if len(unchosen) else np.random.randint(len(weights))
+        return min(np.searchsorted(cumulative, np.random.rand() * cumulative[-1], side='right'),
+                   len(weights) - 1)
+
+    def __seed(self, distances, weights=None):
         """
-        num_c = len(self._clusters_old[ci])
-        return np.dot(x, x) - (2 * sum([np.dot(x, ai) for (l, ai) in self._clusters_old[ci]]) / num_c) \
-               + self._cluster_compactness(ci)
+        choose num_clusters points by the k_means++ algorithm
+        :param distances : function of type f(indices) returning the squared distance
+                           matrix of the points at indices to all the points
+        :param weights : optional weight of each point
+        :return : list of indices of the chosen points
+        """
+        num_points = len(weights) if weights is not None else self.num_samples
+        weights = np.ones(num_points) if weights is None else weights
+        chosen = [self.__sample(weights)]
+        min_distances = distances([chosen[0]])[0]
+
+        for choice in range(1, self.num_clusters):
+            # choose a point from the probability mass function introduced by
+            # D(x) * D(x) where D(x) is distance of point x from its nearest cluster,
+            # the running minimum is updated by one pass per chosen point
+            chosen.append(self.__sample(weights * min_distances, chosen))
+            np.minimum(min_distances, distances([chosen[-1]])[0], out=min_distances)
+        return chosen
 
     def kmeans_init(self):
         """
         initialize the cluster centers based on k_means++ algorithm
         :return : set of initialized cluster means  
         """
-        self._cluster_centers = []
-        # initiliaze the first cluster centroid randomly in space
-        first_label = randint(0, self.num_samples - 1)
-        self._cluster_centers.append((first_label, self.X[first_label]))
+        chosen = self.__seed(self.__point_distances)
+        self._initial_centers = np.asarray(chosen)
 
-        for choice in range(1, self.num_clusters):
-            density_vector = np.zeros(self.num_samples)
-            for label, point in enumerate(self.X):
-                min_dis = min([np.linalg.norm(point - c) for l, c in self._cluster_centers])
-                density_vector[label] = min_dis * min_dis
-            # choose a point from the probability mass function introduced by 
-            # D(x) * D(x) where D(x) is distance of point x from its nearest cluster
-            density_vector /= np.sum(density_vector)
-            density_vector = zip(range(self.num_samples), density_vector)
-            density_vector = sorted(density_vector, key=lambda e: e[1])
-            rand_x, sum_d, choosen_label = random(), 0, 0
-
-            for l, d in density_vector:
-                if sum_d >= rand_x:
-                    choosen_label = l
-                    break
-                else:
-                    sum_d += d
-            self._cluster_centers.append((choosen_label, self.X[choosen_label]))
+    def kmeans_parallel_init(self, oversampling=None, num_rounds=5):
+        """
+        initialize the cluster centers based on k_means|| algorithm, each round
+        samples about oversampling points at once, the sampled candidates weighted
+        by the number of points closest to them are reduced to num_clusters centers
+        with k_means++
+        reference : http://vldb.org/pvldb/vol5/p622_bahmanbahmani_vldb2012.pdf
+        :param oversampling : expected number of candidates sampled per round,
+                              defaults to 2 * num_clusters
+        :param num_rounds : number of sampling rounds
+        """
+        oversampling = oversampling or 2 * self.num_clusters
+        candidates = [np.random.randint(self.num_samples)]
+        min_distances = self.__point_distances(candidates)[0]
+        closest = np.zeros(self.num_samples, dtype=np.int64)
+
+        for sampling_round in range(num_rounds):
+            cost = np.sum(min_distances)
+            if cost <= 0:
+                break
+            sampled = np.flatnonzero(np.random.rand(self.num_samples) < oversampling * min_distances / cost)
+            if len(sampled) == 0:
+                continue
+            distances = self.__point_distances(sampled)
+            nearest = np.argmin(distances, axis=0)
+            nearest_distances = distances[nearest, np.arange(self.num_samples)]
+            closer = nearest_distances < min_distances
+            closest[closer] = len(candidates) + nearest[closer]
+            min_distances[closer] = nearest_distances[closer]
+            candidates.extend(sampled)
+
+        candidates = np.asarray(candidates)
+        if len(candidates) < self.num_clusters:
+            # too few candidates, fill up with distinct random points
+            candidates = np.r_[candidates, np.random.choice(np.setdiff1d(np.arange(self.num_samples), candidates),
+                                                            self.num_clusters - len(candidates), replace=False)]
+        weights = np.bincount(closest, minlength=len(candidates)).astype(np.float64)
+        chosen = self.__seed(lambda indices: self.__point_distances(candidates[indices])[:, candidates],
+                             weights)
+        self._initial_centers = candidates[chosen]
 
     def fit(self, X, Y=None):
         """
@@ -139,122 +355,248 @@ class KMeansKernel:
             feature_value_ranges.append((feature_min, feature_max))
 
         self.cluster_labels = range(self.num_clusters)
-        self._labels = {i: 0 for i in range(self.num_samples)}
+
+        if self.approximation == "nystroem":
+            # cluster with the linear kernel in the approximate feature space
+            self.__fit_feature_map(self.X)
+            self._gram, self._features = None, self.__features(self.X)
+            self._feature_space = True
+            self._gram_diag = np.einsum('ij,ij->i', self._features, self._features)
+        elif self.kernel == 'linear':
+            # the input space is the feature space of the linear kernel, the
+            # gram matrix is not formed
+            self._gram, self._feature_space = None, False
+            self._features = np.asarray(self.X, dtype=np.float64)
+            self._gram_diag = np.einsum('ij,ij->i', self._features, self._features)
+        else:
+            # the kernel (gram) matrix is computed once, every iteration works
+            # off products of it with the label indicator matrix
+            if self.kernel == 'precomputed' and self.num_samples != self.num_features:
+                raise RuntimeError("X must be a square kernel matrix for a precomputed kernel")
+            self._features, self._feature_space = None, False
+            self._gram = pairwise_kernel(self.X, kernel=self.kernel, **self.kernel_params)
+            self._gram_diag = kernel_diagonal(self.X, kernel=self.kernel, **self.kernel_params)
 
         if self.initialization == "random":
-            initial_centers = [randint(0, self.num_samples - 1) for i in range(self.num_clusters)]
-            self._cluster_centers = [(k, self.X[k]) for k in initial_centers]
+            # distinct centers, a repeated one would leave a cluster without members
+            self._initial_centers = np.random.choice(self.num_samples, self.num_clusters, replace=False)
+        elif self.initialization == "kmeans||":
+            self.kmeans_parallel_init()
         else:
             # use kmeans++ algorithm to init the cluster centers
             self.kmeans_init()
 
-        self._clusters = {i: [self._cluster_centers[i]] for i in range(self.num_clusters)}
-        self.iterations = 1
-        while not self.__converged():
-
-            self._cluster_centers_old = self._cluster_centers[:]
-            self._clusters_old = dict(self._clusters)
-            self._clusters = defaultdict(list)
-
-            for cluster_label in self._clusters_old:
-                self._cluster_compactness(cluster_label, True)
-
-            # assign points to the clusters 
-            for data_index, data_point in enumerate(self.X):
-                min_dis, label = min([(abs(self.__distance(data_point, label)), label) for label \
-                                      in self._clusters_old], key=lambda e: e[0])
-                self._labels[data_index] = label
-                self._clusters[label].append((data_index, data_point))
+        # each cluster starts out with its initial center as the only member
+        self._labels = np.full(self.num_samples, -1, dtype=np.int32)
+        self._labels[self._initial_centers] = np.arange(self.num_clusters)
 
-            # recompute the means of the clusters
-            for (cluster_label, points) in self._clusters.items():
-                cluster_center = np.zeros(self.num_features)
-                num_points = 0
-                for l, p in points:
-                    cluster_center = np.add(cluster_center, p)
-                    num_points += 1
-
-                cluster_center /= num_points
-                self._cluster_centers[cluster_label] = cluster_center
-            self.iterations += 1
+        self.history = []
+        self.iterations = 1
+        # every iteration runs its chunks on the same pool of threads
+        pool = self.__pool(self.num_samples)
+        try:
+            while not self.__converged():
+
+                start_time = time.time()
+                gram_indicator, counts, compactness = self.__cluster_terms(self._labels, pool)
+
+                # assign points to the clusters
+                distances = self.__distances(gram_indicator, self._gram_diag, counts, compactness)
+                labels = np.argmin(distances, axis=1).astype(np.int32)
+                inertia = np.sum(distances[np.arange(self.num_samples), labels])
+                changed = np.count_nonzero(labels != self._labels)
+                self._labels = labels
+
+                record = IterationRecord(iteration=self.iterations, elapsed=time.time() - start_time,
+                                         changed=changed, inertia=inertia)
+                self.history.append(record)
+                logger.info("iteration %d took %.3fs, %d points changed cluster, inertia %f", *record)
+                if self.callback:
+                    self.callback(record)
+                self.iterations += 1
+
+            gram_indicator, self._counts, self._compactness = self.__cluster_terms(self._labels, pool)
+        finally:
+            self.__close_pool(pool)
+
+        # means of the clusters in the input space
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self._cluster_centers = self.__cluster_sums(self.X, self._labels) / self._counts[:, None]
+
+        logger.info("Number of iterations ran :: %d", self.iterations)
+        if self.compute_quality:
+            if self._features is None:
+                self.db_index = davies_bouldin_index(self._gram, self._labels, kernel='precomputed',
+                                                     num_clusters=self.num_clusters)
+            else:
+                self.db_index = davies_bouldin_index(self._features, self._labels, kernel='linear',
+                                                     num_clusters=self.num_clusters)
+            logger.info("D-B index for clustering :: %f", self.db_index)
+
+    def partial_fit(self, X, Y=None):
+        """
+        update the clustering with a mini-batch of points, each point moves the
+        centroid of its cluster with a step size of 1 / (number of points the
+        cluster has seen), the clusters are held as per cluster feature sums and
+        counts so memory does not grow with the number of points seen.
+        The first batch is clustered with fit to initialize the clusters if the
+        model was not fitted before, a model fitted exactly with the linear kernel
+        keeps its clusters, they are converted to feature sums.
+        Needs the linear kernel or the nystroem approximation, the feature space of
+        other kernels is not explicit
+        :param X : numpy ndarray of shape (batch_size, num_features) or
+                   a list with similar shape
+        """
+        if not isinstance(X, list) and not isinstance(X, np.ndarray):
+            raise RuntimeError("X must be a list or a numpy ndarray")
+        if self.kernel != 'linear' and self.approximation is None:
+            raise RuntimeError("partial_fit needs the linear kernel or the nystroem approximation")
+        X = np.asarray(X)
+
+        if not self._feature_space:
+            first_batch = self._counts is None
+            if first_batch:
+                self.fit(X)
+            if self.approximation is None:
+                self._feature_sums = self.__cluster_sums(self.X, self._labels)
+                self._feature_space = True
+            # the clusters now live in the feature sums, release the training set
+            self.X, self._gram, self._features = None, None, None
+            self._labels = None
+            if first_batch:
+                return
+
+        pool = self.__pool(X.shape[0])
+        try:
+            labels = self.__assign(X, pool)
+        finally:
+            self.__close_pool(pool)
+
+        # running mean update of the centroids
+        self._feature_sums += self.__cluster_sums(self.__map_features(X), labels)
+        self._counts += self.__cluster_counts(labels)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self._compactness = np.sum(self._feature_sums * self._feature_sums, axis=1) \
+                                / (self._counts * self._counts)
+
+    def __assign(self, X, pool=None):
+        """
+        assign the points X to their nearest cluster of the fitted model,
+        chunk by chunk of points
+        :param X : (num_points, num_features) numpy ndarray
+        :param pool : ThreadPool the chunks run on, None to run them serially
+        :return : integer array of the cluster label of each point
+        """
+        labels = np.empty(X.shape[0], dtype=np.int32)
+        indicator = None if self._feature_space else self.__indicator(self._labels)
+
+        def assign(start, stop):
+            X_chunk = X[start:stop]
+            if self._feature_space:
+                # score the points in the same approximate space the clusters live in
+                features = self.__map_features(X_chunk)
+                kernel_indicator = np.dot(features, self._feature_sums.T)
+                kernel_diag = np.einsum('ij,ij->i', features, features)
+            else:
+                kernel_rows = pairwise_kernel(X_chunk, self.X, kernel=self.kernel, **self.kernel_params)
+                kernel_indicator = np.dot(kernel_rows, indicator)
+                if self.kernel == 'precomputed':
+                    # k(x, x) is the same for every cluster, it does not change the assignment
+                    kernel_diag = np.zeros(X_chunk.shape[0])
+                else:
+                    kernel_diag = kernel_diagonal(X_chunk, kernel=self.kernel, **self.kernel_params)
+            distances = self.__distances(kernel_indicator, kernel_diag, self._counts, self._compactness)
+            labels[start:stop] = np.argmin(distances, axis=1)
 
-        print "Number of iterations ran ::", self.iterations
-        print "D-B index for clustering ::", self.__quality()
+        self.__map_chunks(assign, X.shape[0], pool)
+        return labels
 
     def predict(self, X, Y=None):
         """
         predict the class labels for the data_points in test set X
-        :param X : (num_samples, num_features) shape numpy array or similar shape list
+        :param X : (num_samples, num_features) shape numpy array or similar shape list,
+                   for a precomputed kernel the (num_samples, num_train_samples) kernel
+                   matrix between the test and the training points
         """
         if not isinstance(X, list) and not isinstance(X, np.ndarray):
             raise RuntimeError("X must be a list or a numpy ndarray")
-        labels = []
-        for data_point in X:
-            min_dis, label = min([(abs(self.__distance(data_point, label)), label) for label \
-                                  in self._clusters], key=lambda e: e[0])
-            labels.append(label)
+        X = np.asarray(X)
+        pool = self.__pool(X.shape[0])
+        try:
+            labels = list(self.__assign(X, pool))
+        finally:
+            self.__close_pool(pool)
         if not Y:
             return labels
         else:
             return [(y, label) for (y, label) in it.izip(Y, labels)]
 
+    def save(self, path):
+        """
+        save the fitted model to the directory path, one .npy file per array
+        and a json file of the model parameters, see load
+        :param path : directory to save the model to
+        """
+        if callable(self.kernel):
+            raise RuntimeError("a kernel function can not be saved, register it by name instead")
+        params = {'num_clusters': self.num_clusters, 'num_iterations': self.num_iterations,
+                  'initialization': self.initialization, 'kernel': self.kernel,
+                  'kernel_params': self.kernel_params, 'approximation': self.approximation,
+                  'num_landmarks': self.num_landmarks, 'chunk_size': self.chunk_size}
+        arrays = {'counts': self._counts, 'compactness': self._compactness}
+        feature_space = self._feature_space
+        if feature_space:
+            arrays['feature_sums'] = self._feature_sums
+            if self.approximation == "nystroem":
+                arrays['landmarks'], arrays['feature_map'] = self._landmarks, self._feature_map
+        elif self.kernel == 'linear':
+            # the linear kernel scores points against the cluster sums alone
+            arrays['feature_sums'] = self.__cluster_sums(self.X, self._labels)
+            feature_space = True
+        else:
+            # the exact kernel scores points against the labelled training set
+            arrays['labels'] = self._labels
+            if self.kernel != 'precomputed':
+                arrays['X'] = self.X
+        save_arrays(path, arrays, {'model': 'KMeansKernel', 'params': params,
+                                   'feature_space': feature_space})
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """
+        load a model saved with save, by default the arrays are memory mapped read
+        only so several processes serving predict share one copy of the model,
+        load with mmap_mode=None or "c" to continue training with partial_fit
+        :param path : directory the model was saved to
+        :param mmap_mode : memory map mode of the arrays as in numpy.load
+        :return : KMeansKernel instance
+        """
+        arrays, meta = load_arrays(path, mmap_mode)
+        if meta.get('model') != 'KMeansKernel':
+            raise RuntimeError("no saved KMeansKernel model found at :%s" % path)
+        model = cls(**meta['params'])
+        model._feature_space = meta['feature_space']
+        model._counts, model._compactness = arrays['counts'], arrays['compactness']
+        model._feature_sums = arrays.get('feature_sums')
+        model._landmarks, model._feature_map = arrays.get('landmarks'), arrays.get('feature_map')
+        model._labels, model.X = arrays.get('labels'), arrays.get('X')
+        return model
+
     def __converged(self):
         """
         covergence condition for the k-means, intuitively check 
         the number of cluster re-assignments and infer convergence if 
-        cluster reassignments are less than a threshold
+        cluster reassignments are less than a threshold, or if the
+        inertia decreased by less than the tolerance
         """
         if self.iterations == 1: return False
         if self.iterations >= self.num_iterations: return True
-        point_allocation_old, point_allocation = {}, {}
-
-        for c, elements in self._clusters_old.items():
-            for l, e in elements:
-                point_allocation_old[l] = c
 
-        for c, elements in self._clusters.items():
-            for l, e in elements:
-                point_allocation[l] = c
-
-        movements = 0
-        for e, c in point_allocation.items():
-            if not point_allocation_old.has_key(e):
-                movements += 1
-                continue
-            c_old = point_allocation_old[e]
-            if c_old != c: movements += 1
-
-        print "cluster point movements ::", movements
-        if movements <= 1:
+        last = self.history[-1]
+        if last.changed <= 1:
             return True
-        else:
-            return False
-
-    def __quality(self):
-        """
-        compute the quality of clustering based on Davies-Bouldin
-        index, lower values indicate better clustering
-        reference : https://en.wikipedia.org/wiki/Davies-Bouldin_index
-        """
-        # assign old clusters to new one to measure quality
-        self._clusters_old = self._clusters
-
-        inter_cluster_distances = np.zeros(self.num_clusters)
-        intra_cluster_distances = np.zeros(shape=(self.num_clusters, self.num_clusters))
-        R = np.zeros(shape=(self.num_clusters, self.num_clusters))
-        D = np.zeros(self.num_clusters)
-        for ci, elements in self._clusters.items():
-            num_ci = len(elements)
-            inter_cluster_distances[ci] = sum([self.__distance(e, ci) for l, e in elements]) / num_ci
-
-        for ci in self._clusters:
-            for cj in self._clusters:
-                if ci >= cj: continue
-                intra_cluster_distances[ci, cj] = self._cluster_compactness(ci, cj)
-                intra_cluster_distances[cj, ci] = intra_cluster_distances[ci, cj]
-                R[ci, cj] = (inter_cluster_distances[ci] + inter_cluster_distances[cj]) \
-                            / intra_cluster_distances[ci, cj]
-                R[cj, ci] = R[ci, cj]
-
-        for ci in self._clusters: D[ci] = max(R[ci, :])
-        return sum(D) / self.num_clusters
+        if self.tolerance is not None and len(self.history) > 1:
+            previous = self.history[-2]
+            if previous.inertia - last.inertia <= self.tolerance * abs(previous.inertia):
+                return True
+        return False
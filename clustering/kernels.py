@@ -0,0 +1,158 @@
+from __future__ import division
+
+import numpy as np
+
+# number of rows of X evaluated against Y at a time, bounds the temporary
+# memory of the kernel evaluation to batch_size * len(Y) values
+DEFAULT_BATCH_SIZE = 1024
+
+
+def linear_kernel(X, Y):
+    """
+    linear kernel k(x, y) = <x, y>
+    """
+    return np.dot(X, Y.T)
+
+
+def polynomial_kernel(X, Y, degree=3, gamma=None, coef0=1):
+    """
+    polynomial kernel k(x, y) = (gamma * <x, y> + coef0) ^ degree
+    :param gamma : defaults to 1 / num_features
+    """
+    if gamma is None:
+        gamma = 1 / X.shape[1]
+    K = np.dot(X, Y.T).astype(np.float64, copy=False)
+    K *= gamma
+    K += coef0
+    K **= degree
+    return K
+
+
+def rbf_kernel(X, Y, gamma=None):
+    """
+    gaussian kernel k(x, y) = exp(-gamma * ||x - y||^2)
+    :param gamma : defaults to 1 / num_features
+    """
+    if gamma is None:
+        gamma = 1 / X.shape[1]
+    K = np.dot(X, Y.T).astype(np.float64, copy=False)
+    K *= -2
+    K += np.einsum('ij,ij->i', X, X)[:, None]
+    K += np.einsum('ij,ij->i', Y, Y)[None, :]
+    np.maximum(K, 0, out=K)
+    K *= -gamma
+    np.exp(K, out=K)
+    return K
+
+
+def cosine_kernel(X, Y):
+    """
+    cosine similarity kernel k(x, y) = <x, y> / (||x|| * ||y||),
+    zero vectors have zero similarity with every vector
+    """
+    K = np.dot(X, Y.T).astype(np.float64, copy=False)
+    x_norms, y_norms = np.sqrt(np.einsum('ij,ij->i', X, X)), np.sqrt(np.einsum('ij,ij->i', Y, Y))
+    x_norms[x_norms == 0], y_norms[y_norms == 0] = np.inf, np.inf
+    K /= x_norms[:, None]
+    K /= y_norms[None, :]
+    return K
+
+
+def _linear_diagonal(X):
+    return np.einsum('ij,ij->i', X, X)
+
+
+def _polynomial_diagonal(X, degree=3, gamma=None, coef0=1):
+    if gamma is None:
+        gamma = 1 / X.shape[1]
+    return (gamma * np.einsum('ij,ij->i', X, X) + coef0) ** degree
+
+
+def _rbf_diagonal(X, gamma=None):
+    return np.ones(X.shape[0])
+
+
+def _cosine_diagonal(X):
+    return (np.einsum('ij,ij->i', X, X) > 0).astype(np.float64)
+
+
+# registry of the named kernels, maps a name to the kernel function
+# and a function computing k(x, x) for each row of X
+KERNELS = {
+    'linear': (linear_kernel, _linear_diagonal),
+    'polynomial': (polynomial_kernel, _polynomial_diagonal),
+    'rbf': (rbf_kernel, _rbf_diagonal),
+    'cosine': (cosine_kernel, _cosine_diagonal),
+}
+
+
+def register_kernel(name, kernel, diagonal=None):
+    """
+    register a kernel function to be usable by name
+    :param name : name of the kernel
+    :param kernel : function of type f(X, Y, **params) returning the
+                    (len(X), len(Y)) kernel matrix
+    :param diagonal : optional function of type f(X, **params) returning
+                      k(x, x) for each row x of X, computed blockwise from
+                      the kernel function if not given
+    """
+    if name == 'precomputed':
+        raise RuntimeError("kernel name 'precomputed' is reserved")
+    KERNELS[name] = (kernel, diagonal)
+
+
+def get_kernel(kernel):
+    """
+    resolve a kernel name or function to a (kernel, diagonal) pair
+    """
+    if callable(kernel):
+        return kernel, None
+    if kernel not in KERNELS:
+        raise RuntimeError("Unknown kernel :%s" % kernel)
+    return KERNELS[kernel]
+
+
+def pairwise_kernel(X, Y=None, kernel='linear', batch_size=DEFAULT_BATCH_SIZE, out=None, **params):
+    """
+    evaluate the kernel between every row of X and every row of Y, rows of X
+    are evaluated in batches written into a single output matrix
+    :param X : (num_x, num_features) numpy ndarray, or the kernel matrix
+               itself if kernel is "precomputed"
+    :param Y : (num_y, num_features) numpy ndarray, defaults to X
+    :param kernel : name of a registered kernel, "precomputed" or a kernel function
+    :param batch_size : number of rows of X evaluated at a time
+    :param out : optional (num_x, num_y) array to write the kernel matrix to
+    :return : (num_x, num_y) kernel matrix
+    """
+    if kernel == 'precomputed':
+        return X
+    kernel_func, _ = get_kernel(kernel)
+    if Y is None:
+        Y = X
+    if out is None:
+        out = np.empty(shape=(X.shape[0], Y.shape[0]))
+    for start in xrange(0, X.shape[0], batch_size):
+        stop = min(start + batch_size, X.shape[0])
+        out[start:stop] = kernel_func(X[start:stop], Y, **params)
+    return out
+
+
+def kernel_diagonal(X, kernel='linear', batch_size=DEFAULT_BATCH_SIZE, **params):
+    """
+    evaluate k(x, x) for every row x of X
+    :param X : (num_x, num_features) numpy ndarray, or the (num_x, num_x)
+               kernel matrix if kernel is "precomputed"
+    :param kernel : name of a registered kernel, "precomputed" or a kernel function
+    :return : (num_x,) array of kernel values
+    """
+    if kernel == 'precomputed':
+        return np.diag(X).copy()
+    kernel_func, diagonal_func = get_kernel(kernel)
+    if diagonal_func is not None:
+        return diagonal_func(X, **params)
+
+    diagonal = np.empty(X.shape[0])
+    for start in xrange(0, X.shape[0], batch_size):
+        stop = min(start + batch_size, X.shape[0])
+        diagonal[start:stop] = np.diag(kernel_func(X[start:stop], X[start:stop], **params))
+    return diagonal
@@ -0,0 +1,140 @@
+from __future__ import division
+
+import numpy as np
+
+from clustering.kernels import pairwise_kernel, kernel_diagonal, DEFAULT_BATCH_SIZE
+
+
+def _indicator(labels, num_clusters):
+    """
+    build the (num_samples, num_clusters) label indicator matrix
+    """
+    indicator = np.zeros(shape=(len(labels), num_clusters))
+    indicator[np.arange(len(labels)), labels] = 1
+    return indicator
+
+
+def _kernel_rows(X, rows, kernel, batch_size, **params):
+    """
+    kernel matrix between the points at rows and all the points
+    """
+    if kernel == 'precomputed':
+        return X[rows]
+    return pairwise_kernel(X[rows], X, kernel=kernel, batch_size=batch_size, **params)
+
+
+def _kernel_product(X, W, kernel, batch_size, **params):
+    """
+    compute K(X, X) * W one block of rows at a time, the full kernel
+    matrix is never formed unless it is precomputed
+    """
+    if kernel == 'precomputed':
+        return np.dot(X, W)
+    if kernel == 'linear':
+        return np.dot(X, np.dot(X.T, W))
+
+    product = np.empty(shape=(X.shape[0], W.shape[1]))
+    for start in xrange(0, X.shape[0], batch_size):
+        stop = min(start + batch_size, X.shape[0])
+        product[start:stop] = np.dot(_kernel_rows(X, slice(start, stop), kernel, batch_size, **params), W)
+    return product
+
+
+def davies_bouldin_index(X, labels, kernel='linear', num_clusters=None,
+                         batch_size=DEFAULT_BATCH_SIZE, **params):
+    """
+    compute the Davies-Bouldin index of a clustering in the feature space of a kernel,
+    lower values indicate better clustering, clusters with no points are ignored
+    reference : https://en.wikipedia.org/wiki/Davies-Bouldin_index
+    :param X : (num_samples, num_features) numpy ndarray, or the kernel matrix
+               if kernel is "precomputed"
+    :param labels : integer array of the cluster label of each sample
+    :param kernel : kernel name or function, see clustering.kernels
+    :param num_clusters : number of clusters, defaults to max(labels) + 1
+    :param batch_size : number of rows of the kernel matrix evaluated at a time
+    :param params : parameters of the kernel function
+    """
+    labels = np.asarray(labels)
+    num_clusters = num_clusters or np.max(labels) + 1
+    indicator = _indicator(labels, num_clusters)
+    counts = np.sum(indicator, axis=0)
+    occupied = counts > 0
+
+    kernel_indicator = _kernel_product(X, indicator, kernel, batch_size, **params)
+    centroid_products = np.dot(indicator.T, kernel_indicator)[occupied][:, occupied] \
+                        / np.outer(counts[occupied], counts[occupied])
+    centroid_norms = np.diag(centroid_products)
+
+    # average distance of the points in a cluster to its centroid
+    own_cluster = np.zeros(num_clusters)
+    own_cluster[occupied] = centroid_norms
+    member_distances = kernel_diagonal(X, kernel=kernel, batch_size=batch_size, **params) \
+                       - 2 * kernel_indicator[np.arange(len(labels)), labels] / counts[labels] \
+                       + own_cluster[labels]
+    member_distances = np.sqrt(np.maximum(member_distances, 0))
+    scatter = np.bincount(labels, weights=member_distances, minlength=num_clusters)[occupied] \
+              / counts[occupied]
+
+    # distance between the centroids from their pairwise inner products
+    separation = np.sqrt(np.maximum(centroid_norms[:, None] + centroid_norms[None, :]
+                                    - 2 * centroid_products, 0))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        R = (scatter[:, None] + scatter[None, :]) / separation
+    np.fill_diagonal(R, 0)
+    R[~np.isfinite(R)] = 0
+    return np.mean(np.max(R, axis=1))
+
+
+def silhouette_score(X, labels, kernel='linear', num_clusters=None, sample_size=None,
+                     batch_size=DEFAULT_BATCH_SIZE, **params):
+    """
+    compute the mean silhouette coefficient of a clustering in the feature space of a
+    kernel, optionally over a random sample of the points, values close to 1 indicate
+    dense well separated clusters. Points in a cluster of their own score 0
+    reference : https://en.wikipedia.org/wiki/Silhouette_(clustering)
+    :param X : (num_samples, num_features) numpy ndarray, or the kernel matrix
+               if kernel is "precomputed"
+    :param labels : integer array of the cluster label of each sample
+    :param kernel : kernel name or function, see clustering.kernels
+    :param num_clusters : number of clusters, defaults to max(labels) + 1
+    :param sample_size : number of points to average over, defaults to all the points,
+                         each sampled point costs one row of the kernel matrix
+    :param batch_size : number of sampled points evaluated at a time
+    :param params : parameters of the kernel function
+    """
+    labels = np.asarray(labels)
+    num_samples = len(labels)
+    num_clusters = num_clusters or np.max(labels) + 1
+    indicator = _indicator(labels, num_clusters)
+    counts = np.sum(indicator, axis=0)
+    diagonal = kernel_diagonal(X, kernel=kernel, batch_size=batch_size, **params)
+
+    if sample_size is None or sample_size >= num_samples:
+        sample = np.arange(num_samples)
+    else:
+        sample = np.random.choice(num_samples, sample_size, replace=False)
+
+    scores = np.empty(len(sample))
+    for start in xrange(0, len(sample), batch_size):
+        rows = sample[start:start + batch_size]
+        distances = diagonal[rows][:, None] + diagonal[None, :] \
+                    - 2 * _kernel_rows(X, rows, kernel, batch_size, **params)
+        distances = np.sqrt(np.maximum(distances, 0))
+        cluster_distances = np.dot(distances, indicator)
+
+        # mean distance to the other points of the own cluster, and to the nearest other cluster
+        own = labels[rows]
+        own_counts = counts[own] - 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            a = cluster_distances[np.arange(len(rows)), own] / own_counts
+            mean_distances = cluster_distances / counts
+        mean_distances[:, counts == 0] = np.inf
+        mean_distances[np.arange(len(rows)), own] = np.inf
+        b = np.min(mean_distances, axis=1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            batch_scores = (b - a) / np.maximum(a, b)
+        batch_scores[(own_counts == 0) | ~np.isfinite(batch_scores)] = 0
+        scores[start:start + len(rows)] = batch_scores
+    return np.mean(scores)
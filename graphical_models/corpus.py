@@ -0,0 +1,106 @@
+from __future__ import division, absolute_import
+
+import numpy as np
+
+from util.persistence import save_arrays, load_arrays
+
+
+class SequenceCorpus(object):
+    """
+    A corpus of integer encoded sequences in a ragged array layout, the emission ids
+    of all the sequences are held in one flat int32 array and sequence i is
+    emission_ids[offsets[i]:offsets[i + 1]]. The state ids of labelled sequences are
+    held in a second flat array of the same layout. Sequences are views into the flat
+    arrays, so a corpus memory mapped from disk is never read to memory as a whole
+    """
+
+    def __init__(self, emission_ids, offsets, state_ids=None):
+        """
+        :param emission_ids: flat array of the emission ids of all the sequences
+        :param offsets: (num_sequences + 1,) array of the start of every sequence in
+        emission_ids followed by the total length
+        :param state_ids: flat array of the state ids of all the sequences, None for
+        unlabelled sequences
+        """
+        assert offsets[0] == 0 and offsets[-1] == len(emission_ids), "offsets do not match the emission ids"
+        assert state_ids is None or len(state_ids) == len(emission_ids), "state ids do not match the emission ids"
+        self.emission_ids = emission_ids
+        self.offsets = offsets
+        self.state_ids = state_ids
+
+    @classmethod
+    def from_sequences(cls, emitted_sequences, state_sequences=None):
+        """
+        build a corpus from sequences of ids
+        :param emitted_sequences: sequence of emission id sequences
+        :param state_sequences: sequence of state id sequences of the same lengths, or None
+        """
+        sequence_lens = [len(emitted_seq) for emitted_seq in emitted_sequences]
+        offsets = np.zeros(shape=(len(sequence_lens) + 1,), dtype=np.int64)
+        np.cumsum(sequence_lens, out=offsets[1:])
+
+        emission_ids = np.fromiter((em_id for emitted_seq in emitted_sequences for em_id in emitted_seq),
+                                   dtype=np.int32, count=offsets[-1])
+        state_ids = None
+        if state_sequences is not None:
+            state_ids = np.fromiter((state_id for state_seq in state_sequences for state_id in state_seq),
+                                    dtype=np.int32, count=offsets[-1])
+        return cls(emission_ids, offsets, state_ids)
+
+    @property
+    def labelled(self):
+        return self.state_ids is not None
+
+    @property
+    def sequence_lens(self):
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, seq_id):
+        return self.emission_ids[self.offsets[seq_id]:self.offsets[seq_id + 1]]
+
+    def __iter__(self):
+        for seq_id in xrange(len(self)):
+            yield self[seq_id]
+
+    def states(self, seq_id):
+        """
+        get the state ids of a labelled sequence
+        """
+        if not self.labelled:
+            raise RuntimeError("the corpus has no state sequences")
+        return self.state_ids[self.offsets[seq_id]:self.offsets[seq_id + 1]]
+
+    def padded(self, pad_value=0):
+        """
+        get the emission ids of all the sequences padded to the length of the longest
+        :return: ((num_sequences, max_sequence_len) array of emission ids,
+        (num_sequences,) array of the sequence lengths)
+        """
+        sequence_lens = self.sequence_lens
+        max_sequence_len = np.max(sequence_lens) if len(self) else 0
+        emitted_seqs = np.full((len(self), max_sequence_len), pad_value, dtype=np.int32)
+        emitted_seqs[np.arange(max_sequence_len)[None, :] < sequence_lens[:, None]] = self.emission_ids
+        return emitted_seqs, sequence_lens
+
+    def save(self, path):
+        """
+        save the corpus to the directory path, one .npy file per array
+        :param path: directory to save the corpus to
+        """
+        save_arrays(path, {'emission_ids': self.emission_ids, 'offsets': self.offsets,
+                           'state_ids': self.state_ids}, {'model': 'SequenceCorpus'})
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """
+        load a corpus saved with save, by default the arrays are memory mapped read only
+        :param path: directory the corpus was saved to
+        :param mmap_mode: memory map mode of the arrays as in numpy.load, None reads them to memory
+        """
+        arrays, meta = load_arrays(path, mmap_mode)
+        if meta.get('model') != 'SequenceCorpus':
+            raise RuntimeError("no saved corpus found at :%s" % path)
+        return cls(arrays['emission_ids'], arrays['offsets'], arrays.get('state_ids'))
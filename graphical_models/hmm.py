@@ -1,63 +1,219 @@
-from __future__ import division
+from __future__ import division, absolute_import
 from collections import namedtuple
+from multiprocessing import Pool, cpu_count
+import cPickle as pickle
+import os
 
 import numpy as np
-import itertools
+import scipy.sparse as sp
+
+from graphical_models.corpus import SequenceCorpus
+from util.persistence import save_arrays, load_arrays
+
+# number of (time step, state) posterior probabilities buffered before they are
+# added to the sparse emission counts
+SPARSE_COUNT_BUFFER_SIZE = 1 << 20
+
+# file of the symbol tables of a saved HMM, pickled so the symbols keep their types
+SYMBOLS_FILE = 'symbols.pkl'
+
+# exponent of the default step size schedule of online EM, (k + 2) ^ -STEP_SIZE_DECAY
+# at update k, any exponent in (0.5, 1] satisfies the stochastic approximation conditions
+STEP_SIZE_DECAY = 0.7
 
 HMMEmission = namedtuple("HMMEmission", ['em_id', 'value'])
-OptimalAssignment = namedtuple("OptimalAssignment", ['optimal_state_sequence', 'forward_prob_matrix'])
+SupervisedCounts = namedtuple("SupervisedCounts", ['initial_counts', 'state_counts', 'transition_counts',
+                                                   'emission_counts', 'num_sequences'])
+OptimalAssignment = namedtuple("OptimalAssignment", ['optimal_state_sequence', 'forward_prob_matrix',
+                                                     'log_likelihood'])
+
+
+def default_step_size(num_updates):
+    """
+    step size of online EM at update num_updates (counting from 0)
+    """
+    return (num_updates + 2) ** -STEP_SIZE_DECAY
 
 
-class HMMState:
+class SparseEmissionMatrix(object):
     """
-    An HMM state, holds the transition and emission probabilities
+    Emission probabilities of an HMM held as a sparse matrix of (expected) emission
+    counts, smoothed on the fly as
+    p(o | s) = (count(s, o) + smoothing) / (count(s) + smoothing * num_emissions)
+    so memory scales with the number of observed (state, emission) pairs. With
+    smoothing 0 and rows summing to 1 the counts are the probabilities themselves
     """
 
-    def __init__(self, node_id, name=None, prior=None):
+    def __init__(self, counts, smoothing):
+        self.counts = sp.csc_matrix(counts, dtype=np.float64)
+        self.smoothing = smoothing
+        self.shape = self.counts.shape
+        self.totals = np.asarray(self.counts.sum(axis=1), dtype=np.float64).ravel()
+        self.denominators = self.totals + smoothing * self.shape[1]
+
+    def columns(self, emission_ids):
+        """
+        get the emission probabilities of the emission ids, only the columns of the
+        emission ids are touched
+        :param emission_ids: sequence of emission ids
+        :return: np.ndarray of shape (num_states, len(emission_ids))
+        """
+        return (self.counts[:, emission_ids].toarray() + self.smoothing) / self.denominators[:, None]
+
+    def resized(self, shape):
+        """
+        get the emission matrix with more states or emissions, the counts added are 0
+        """
+        counts = self.counts.tocoo()
+        return SparseEmissionMatrix(sp.coo_matrix((counts.data, (counts.row, counts.col)), shape=shape),
+                                    self.smoothing)
+
+    def max_difference(self, other):
+        """
+        get the largest absolute difference of the probabilities of two emission matrices
+        of the same shape, over the stored entries and the smoothed entries of each row
+        """
+        row_offsets = self.smoothing / self.denominators - other.smoothing / other.denominators
+        differences = (self.counts.multiply(1 / self.denominators[:, None])
+                       - other.counts.multiply(1 / other.denominators[:, None])).tocoo()
+        max_difference = np.max(np.abs(differences.data + row_offsets[differences.row])) \
+            if differences.nnz else 0
+        # rows with entries stored in neither matrix differ by the row offset alone
+        stored = np.bincount(differences.row, minlength=self.shape[0])
+        unstored_offsets = np.abs(row_offsets[stored < self.shape[1]])
+        return max(max_difference, np.max(unstored_offsets) if len(unstored_offsets) else 0)
+
+    def toarray(self):
+        return (self.counts.toarray() + self.smoothing) / self.denominators[:, None]
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            state_id, emission_id = index
+            return (self.counts[state_id, emission_id] + self.smoothing) / self.denominators[state_id]
+        return (self.counts[index].toarray().ravel() + self.smoothing) / self.denominators[index]
+
+
+class HMMState(object):
+    """
+    An HMM state, a view of the prior, the transition and the emission
+    probabilities of the state held in the matrices of its HMM
+    """
+
+    def __init__(self, hmm, node_id, name=None):
+        self.hmm = hmm
         self.state_id = node_id
         self.state_name = name
-        self.prior = prior
-        self.transitions = dict()
-        self.emissions = dict()
+
+    @property
+    def prior(self):
+        prior = self.hmm.priors[self.state_id]
+        return None if np.isnan(prior) else prior
+
+    @prior.setter
+    def prior(self, p_value):
+        self.hmm.priors[self.state_id] = np.nan if p_value is None else p_value
+
+    @property
+    def transitions(self):
+        return self.hmm.transition_matrix[self.state_id]
+
+    @property
+    def emissions(self):
+        return self.hmm.emission_matrix[self.state_id]
 
     def set_transition_prob(self, state_id, p_value):
         self.transitions[state_id] = p_value
 
     def set_emission_prob(self, emission_id, p_value):
+        if isinstance(self.hmm.emission_matrix, SparseEmissionMatrix):
+            raise RuntimeError("emission probabilities of a sparse emission matrix can not be set one by one")
         self.emissions[emission_id] = p_value
 
     def get_transition_prob(self, state_id):
-        if self.transitions.has_key(state_id):
+        if 0 <= state_id < self.hmm.num_states and not np.isnan(self.transitions[state_id]):
             return self.transitions[state_id]
         else:
             raise RuntimeError("transition probability not known for state_id :%s" % state_id)
 
     def get_emission_prob(self, emission_id):
-        if self.emissions.has_key(emission_id):
-            return self.emissions[emission_id]
+        if 0 <= emission_id < self.hmm.num_emissions and \
+                not np.isnan(self.hmm.emission_matrix[self.state_id, emission_id]):
+            return self.hmm.emission_matrix[self.state_id, emission_id]
         else:
             raise RuntimeError("emission probability not known for emission :%s" % emission_id)
 
 
-class HMM:
+class HMM(object):
     """
     An implementation of Hidden Markov Model with discrete state transitions
-    and discrete output value(s)
+    and discrete output value(s), the parameters are held in dense matrices,
+    probabilities not set yet are NaN. With sparse_emissions the emission
+    probabilities are held as a SparseEmissionMatrix of emission counts
+    for large vocabularies.
+    The models can be updated online with partial_fit, step_size is the step size
+    schedule of online EM, a function of the number of updates so far
     """
-    def __init__(self, smoothing=0.01, tolerance=1e-4):
+    def __init__(self, smoothing=0.01, tolerance=1e-4, sparse_emissions=False, step_size=default_step_size):
         self.states, self.emissions = [], []
+        # symbol to id maps of the states and the emissions
+        self._state_index, self._emission_index = {}, {}
         self.num_states, self.num_emissions = 0, 0
         self.iterations = 0
         self.smoothing = smoothing
         self.tolerance = tolerance
+        self.sparse_emissions = sparse_emissions
+        self.step_size = step_size
+        # counts of the supervised training sequences seen, and the running expected
+        # counts of online EM, for partial_fit
+        self._supervised_counts, self._expected_counts = None, None
+        self._num_updates = 0
+        self._transition_matrix = np.empty(shape=(0, 0), dtype=np.float64)
+        self._emission_matrix = SparseEmissionMatrix(sp.csc_matrix((0, 0)), smoothing) if sparse_emissions \
+            else np.empty(shape=(0, 0), dtype=np.float64)
+        self._priors = np.empty(shape=(0,), dtype=np.float64)
+
+    @staticmethod
+    def __resized(matrix, shape):
+        """
+        resize a parameter matrix to shape, keeping its values, the parameters
+        added are NaN. Resizing is deferred to the first access of a matrix after
+        states or emissions are added, so adding them one at a time does not copy
+        the matrices every time
+        """
+        if matrix.shape == shape:
+            return matrix
+        if isinstance(matrix, SparseEmissionMatrix):
+            return matrix.resized(shape)
+        resized = np.full(shape, np.nan)
+        resized[tuple(slice(0, size) for size in matrix.shape)] = matrix
+        return resized
+
+    @property
+    def transition_matrix(self):
+        self._transition_matrix = self.__resized(self._transition_matrix, (self.num_states, self.num_states))
+        return self._transition_matrix
+
+    @property
+    def emission_matrix(self):
+        self._emission_matrix = self.__resized(self._emission_matrix, (self.num_states, self.num_emissions))
+        return self._emission_matrix
+
+    @property
+    def priors(self):
+        self._priors = self.__resized(self._priors, (self.num_states,))
+        return self._priors
 
     def add_state(self, state_name, prior=None):
-        state = HMMState(self.num_states, state_name, prior)
+        state = HMMState(self, self.num_states, state_name)
+        self._state_index[state_name] = state.state_id
         self.states.append(state)
         self.num_states += 1
+        if prior is not None:
+            state.prior = prior
 
     def add_emission(self, emission_value):
         emission = HMMEmission(em_id=self.num_emissions, value=emission_value)
+        self._emission_index[emission_value] = emission.em_id
         self.num_emissions += 1
         self.emissions.append(emission)
 
@@ -68,99 +224,140 @@ class HMM:
         :return:
         """
         assert prob_matrix.shape == (self.num_states, self.num_states), "shape mismatch of transition matrix"
-        for state_id in xrange(prob_matrix.shape[0]):
-            state = self.states[state_id]
-            probabilities = prob_matrix[state_id]
-
-            if not state.prior:
-                state.prior = (1 / self.num_states)
-
-            for _id, p in enumerate(probabilities):
-                state.set_transition_prob(_id, p)
+        priors = self.priors
+        priors[np.isnan(priors) | (priors == 0)] = 1 / self.num_states
+        self._transition_matrix = np.array(prob_matrix, dtype=np.float64)
 
     def get_transition_matrix(self):
         """
         get the state transition matrix of the model
         :return: np.ndarray of shape (num_states, num_states)
         """
-        transition_matrix = np.ndarray(shape=(self.num_states, self.num_states), dtype=np.float128)
-        for state_id in xrange(self.num_states):
-            transitions = sorted(self.states[state_id].transitions.items(), key=lambda e: e[0])
-            transitions = zip(*transitions)[1]
-            transition_matrix[state_id] = transitions
-        return transition_matrix
+        return self.transition_matrix
 
     def get_emission_matrix(self):
         """
         get the state to output emission matrix of the model
         :return: np.ndarray of shape (num_states, num_emissions)
         """
-        emission_matrix = np.ndarray(shape=(self.num_states, self.num_emissions), dtype=np.float128)
-        for state_id in xrange(self.num_states):
-            emissions = sorted(self.states[state_id].emissions.items(), key=lambda e: e[0])
-            emissions = zip(*emissions)[1]
-            emission_matrix[state_id] = emissions
-        return emission_matrix
+        return self.emission_matrix
 
     def add_emission_prob(self, prob_matrix):
         """
         add a emission probability matrix
-        :param prob_matrix: a numpy array of shape (states, emissions)
+        :param prob_matrix: a numpy array of shape (states, emissions), a scipy sparse
+        matrix of the probabilities or a SparseEmissionMatrix, it is stored in the form
+        sparse_emissions asks for
         :return:
         """
         assert prob_matrix.shape == (self.num_states, self.num_emissions), "shape mismatch of emissions matrix"
-        for state_id in xrange(prob_matrix.shape[0]):
-            state = self.states[state_id]
-            emission_probabilities = prob_matrix[state_id]
-            for emission_id, p in enumerate(emission_probabilities):
-                state.set_emission_prob(emission_id, p)
+        if not self.sparse_emissions:
+            if isinstance(prob_matrix, SparseEmissionMatrix) or sp.issparse(prob_matrix):
+                prob_matrix = prob_matrix.toarray()
+            self._emission_matrix = np.array(prob_matrix, dtype=np.float64)
+        elif isinstance(prob_matrix, SparseEmissionMatrix):
+            self._emission_matrix = prob_matrix
+        else:
+            self._emission_matrix = SparseEmissionMatrix(sp.csc_matrix(prob_matrix), 0)
+
+    def encode(self, sequences, labelled=False):
+        """
+        encode sequences of symbols once into a SequenceCorpus of ids, training and
+        decoding on the corpus skip the symbol lookups
+        :param sequences: a sequence of sequences of emission values, or with labelled
+        a sequence of sequences of type [(o,z)] where o is the observed output and z is
+        the observed state
+        :param labelled: the sequences carry the observed states
+        :return: SequenceCorpus of the sequences
+        """
+        emission_index, state_index = self._emission_index, self._state_index
+        try:
+            if not labelled:
+                return SequenceCorpus.from_sequences([[emission_index[em_symbol] for em_symbol in emission_seq]
+                                                      for emission_seq in sequences])
+            emitted_sequences, state_sequences = [], []
+            for train_sequence in sequences:
+                emitted_sequences.append([emission_index[em_symbol] for em_symbol, _ in train_sequence])
+                state_sequences.append([state_index[obs_state] for _, obs_state in train_sequence])
+            return SequenceCorpus.from_sequences(emitted_sequences, state_sequences)
+        except KeyError as error:
+            raise RuntimeError("unknown symbol :%s" % error.args[0])
+
+    def __corpus(self, sequences, labelled=False):
+        if isinstance(sequences, SequenceCorpus):
+            if labelled and not sequences.labelled:
+                raise RuntimeError("the corpus has no state sequences")
+            return sequences
+        return self.encode(sequences, labelled)
+
+    def get_priors(self):
+        """
+        get the prior probabilities of the states
+        :return: np.ndarray of shape (num_states,)
+        """
+        return self.priors
 
-    def __compute_forward_prob(self, emitted_seq):
+    @staticmethod
+    def __observation_prob(emitted_seq, emission_matrix):
         """
-        compute the forward transition probability matrix
-        :param emitted_seq: emission id sequence of emissions as training
-        :return: forward probability matrix of the sequence
+        get the emission probability of the observed symbol at every time step
+        :param emitted_seq: emission id sequence
+        :param emission_matrix: np.ndarray of shape (num_states, num_emissions)
+        or a SparseEmissionMatrix
+        :return: np.ndarray of shape (sequence_len, num_states)
         """
-        sequence_len = len(emitted_seq)
-        forward_prob = np.ndarray(shape=(self.num_states, sequence_len), dtype=np.float128)
+        if isinstance(emission_matrix, SparseEmissionMatrix):
+            return emission_matrix.columns(emitted_seq).T
+        return emission_matrix[:, emitted_seq].T
 
-        for i in range(self.num_states):
-            forward_prob[i, 0] = self.states[i].prior * self.states[i].get_emission_prob(emitted_seq[0])
+    @staticmethod
+    def __compute_forward_prob(observation_prob, transition_matrix, priors):
+        """
+        compute the scaled forward probability matrix, the forward probabilities
+        of each time step are normalized to sum to 1 to avoid underflow
+        :param observation_prob: (sequence_len, num_states) emission probabilities
+        of the observed symbols
+        :param transition_matrix: (num_states, num_states) transition probabilities
+        :param priors: (num_states,) prior probabilities of the states
+        :return: (forward probability matrix of shape (sequence_len, num_states),
+        scale factors of shape (sequence_len,)), the log likelihood of the sequence
+        is the sum of the log of the scale factors
+        """
+        sequence_len, num_states = observation_prob.shape
+        forward_prob = np.empty(shape=(sequence_len, num_states), dtype=np.float64)
+        scales = np.empty(shape=(sequence_len,), dtype=np.float64)
+
+        forward_prob[0] = priors * observation_prob[0]
+        scales[0] = np.sum(forward_prob[0])
+        forward_prob[0] /= scales[0]
 
         for time_seq in xrange(1, sequence_len):
-            for j in xrange(self.num_states):
-                forward_prob[j, time_seq] = sum([forward_prob[i, time_seq - 1] * self.states[i]
-                                                .get_transition_prob(j) * self.states[j]
-                                                .get_emission_prob(emitted_seq[time_seq])
-                                                 for i in xrange(self.num_states)])
-            # Avoid underflow on probabilities
-            for j in xrange(self.num_states):
-                forward_prob[j, time_seq] = forward_prob[j, time_seq] / np.sum(forward_prob[:, time_seq])
+            forward_prob[time_seq] = np.dot(forward_prob[time_seq - 1], transition_matrix) \
+                                     * observation_prob[time_seq]
+            scales[time_seq] = np.sum(forward_prob[time_seq])
+            forward_prob[time_seq] /= scales[time_seq]
 
-        return forward_prob
+        return forward_prob, scales
 
-    def __compute_backward_prob(self, emitted_seq):
+    @staticmethod
+    def __compute_backward_prob(observation_prob, transition_matrix, scales):
         """
-        compute the backward transition probability matrix
-        :param emitted_seq: emission id sequence of emissions as training
-        :return: backward transitions probability matrix of the sequence
+        compute the backward probability matrix, scaled by the scale factors
+        of the forward probabilities
+        :param observation_prob: (sequence_len, num_states) emission probabilities
+        of the observed symbols
+        :param transition_matrix: (num_states, num_states) transition probabilities
+        :param scales: (sequence_len,) scale factors of the forward probabilities
+        :return: backward probability matrix of shape (sequence_len, num_states)
         """
-        sequence_len = len(emitted_seq)
-        bckward_prob = np.ndarray(shape=(self.num_states, sequence_len), dtype=np.float128)
-
-        for i in range(self.num_states):
-            bckward_prob[i, sequence_len - 1] = 1
+        sequence_len, num_states = observation_prob.shape
+        bckward_prob = np.empty(shape=(sequence_len, num_states), dtype=np.float64)
+        bckward_prob[sequence_len - 1] = 1
 
-        for time_seq in xrange(sequence_len - 2, 0, -1):
-            for i in xrange(self.num_states):
-                em_symbol = emitted_seq[time_seq + 1]
-                bckward_prob[i, time_seq] = sum([bckward_prob[j, time_seq + 1] * self.states[i]
-                                                .get_transition_prob(j) * self.states[j]
-                                                .get_emission_prob(em_symbol) for j in xrange(self.num_states)])
-
-            # Avoid underflow on probabilities
-            for j in xrange(self.num_states):
-                bckward_prob[j, time_seq] = bckward_prob[j, time_seq] / np.sum(bckward_prob[:, time_seq])
+        for time_seq in xrange(sequence_len - 2, -1, -1):
+            bckward_prob[time_seq] = np.dot(transition_matrix,
+                                            observation_prob[time_seq + 1] * bckward_prob[time_seq + 1]) \
+                                     / scales[time_seq + 1]
 
         return bckward_prob
 
@@ -180,13 +377,13 @@ class HMM:
         transition_matrix_new = self.get_transition_matrix()
         emission_matrix_new = self.get_emission_matrix()
 
-        diff_transitions = transition_matrix_new - transition_matrix_old
-        diff_emissions = emission_matrix_new - emission_matrix_old
-
-        transitions_above_tolerance = np.count_nonzero(diff_transitions > self.tolerance)
-        emissions_above_tolerance = np.count_nonzero(diff_emissions > self.tolerance)
+        diff_transitions = np.max(np.abs(transition_matrix_new - transition_matrix_old))
+        if isinstance(emission_matrix_new, SparseEmissionMatrix):
+            diff_emissions = emission_matrix_new.max_difference(emission_matrix_old)
+        else:
+            diff_emissions = np.max(np.abs(emission_matrix_new - emission_matrix_old))
 
-        if transitions_above_tolerance > 0 or emissions_above_tolerance > 0:
+        if diff_transitions > self.tolerance or diff_emissions > self.tolerance:
             return False
 
         return True
@@ -196,177 +393,645 @@ class HMM:
         Train the HMM in a supervised manner using smoothed MLE estimates
          from the training set
         :param train_sequences: a sequence of sequences where each sequence is of type
-        [(o,z)] where o is the observed output and z is the observed state
+        [(o,z)] where o is the observed output and z is the observed state, or a
+        labelled SequenceCorpus
         :param train_prior: train the prior probabilities of the state(s)
         :return:
         """
-        obs_emissions = {}
-        obs_states = {}
-
-        for emission in self.emissions:
-            obs_emissions[emission.value] = emission.em_id
-        for state in self.states:
-            obs_states[state.state_name] = state.state_id
+        self._supervised_counts = self.__supervised_counts(self.__corpus(train_sequences, labelled=True))
+        self.__estimate(train_prior)
 
-        # initialize the count DS to all zero's
-        state_count = np.zeros(shape=(self.num_states,), dtype=np.uint32)
-        state_bi_count = np.zeros(shape=(self.num_states,self.num_states), dtype=np.uint32)
-        state_emission_count = np.zeros(shape=(self.num_states, self.num_emissions), dtype=np.uint32)
+    def __supervised_counts(self, corpus):
+        """
+        count the initial states, the states, the state bigrams and the emissions
+        of each state of a labelled corpus
+        :return: SupervisedCounts of the corpus
+        """
+        emission_ids, state_ids, offsets = corpus.emission_ids, corpus.state_ids, corpus.offsets
+
+        # count the state bigrams that do not cross a sequence boundary
+        within_sequence = np.ones(shape=(max(len(state_ids) - 1, 0),), dtype=bool)
+        boundaries = offsets[1:-1]
+        within_sequence[boundaries[(boundaries > 0) & (boundaries < len(state_ids))] - 1] = False
+        state_bigrams = state_ids[:-1][within_sequence] * self.num_states + state_ids[1:][within_sequence]
+        state_bi_count = np.bincount(state_bigrams, minlength=self.num_states ** 2) \
+            .reshape(self.num_states, self.num_states)
+
+        if self.sparse_emissions:
+            state_emission_count = sp.coo_matrix((np.ones(len(emission_ids)), (state_ids, emission_ids)),
+                                                 shape=(self.num_states, self.num_emissions)).tocsc()
+        else:
+            state_emission_count = np.bincount(state_ids.astype(np.int64) * self.num_emissions + emission_ids,
+                                               minlength=self.num_states * self.num_emissions) \
+                .reshape(self.num_states, self.num_emissions)
+
+        return SupervisedCounts(
+            initial_counts=np.bincount(state_ids[offsets[:-1][corpus.sequence_lens > 0]],
+                                       minlength=self.num_states),
+            state_counts=np.bincount(state_ids, minlength=self.num_states),
+            transition_counts=state_bi_count, emission_counts=state_emission_count,
+            num_sequences=len(corpus))
+
+    def __estimate(self, train_prior):
+        """
+        set the smoothed MLE estimates of the parameters from the supervised counts,
+        online EM of partial_fit restarts from them
+        """
+        self._expected_counts, self._num_updates = None, 0
+        counts = self._supervised_counts
+        state_count = counts.state_counts
+        transition_matrix = (counts.transition_counts + self.smoothing) / \
+                            (state_count[:, None] + self.smoothing * self.num_states)
+        if self.sparse_emissions:
+            emission_matrix = SparseEmissionMatrix(counts.emission_counts, self.smoothing)
+        else:
+            emission_matrix = (counts.emission_counts + self.smoothing) / \
+                              (state_count[:, None] + self.smoothing * self.num_emissions)
 
         if train_prior:
-            state_initial = np.zeros(shape=(self.num_states,), dtype=np.uint32)
-
-        for train_sequence in train_sequences:
-            emission_seq, state_seq = zip(*train_sequence)
+            self.priors[:] = (counts.initial_counts + self.smoothing) / \
+                             (counts.num_sequences + self.smoothing * self.num_states)
 
-            emitted_seq = np.array([obs_emissions[em_symbol] for em_symbol in emission_seq])
-            observed_state_seq = np.array([obs_states[obs_state] for obs_state in state_seq])
-
-            if train_prior:
-                state_initial[observed_state_seq[0]] += 1
-
-            for state_id in xrange(self.num_states):
-                state_count[state_id] += np.count_nonzero(observed_state_seq == state_id)
-
-            for (state_id_prev, state_id_id_current) in itertools.izip(observed_state_seq, observed_state_seq[1:]):
-                state_bi_count[state_id_prev, state_id_id_current] += 1
+        self.add_transition_prob(transition_matrix)
+        self.add_emission_prob(emission_matrix)
 
-            for (state_id, emission_id) in itertools.izip(observed_state_seq, emitted_seq):
-                state_emission_count[state_id, emission_id] += 1
+    @staticmethod
+    def expected_counts(emitted_sequences, transition_matrix, emission_matrix, priors):
+        """
+        E-step of EM (Baum-Welch), accumulate the expected counts of the initial states,
+        the state transitions and the emissions of the emission sequences under the
+        model parameters, only the counts are kept so the memory used does not grow
+        with the length or the number of the sequences
+        :param emitted_sequences: sequence of emission id sequences
+        :param transition_matrix: (num_states, num_states) transition probabilities
+        :param emission_matrix: (num_states, num_emissions) emission probabilities, or a
+        SparseEmissionMatrix
+        :param priors: (num_states,) prior probabilities of the states
+        :return: (expected initial state counts of shape (num_states,), expected transition
+        counts of shape (num_states, num_states), expected emission counts of shape
+        (num_states, num_emissions), a scipy sparse matrix for a SparseEmissionMatrix,
+        log likelihood of the sequences)
+        """
+        num_states, num_emissions = emission_matrix.shape
+        prior_counts = np.zeros(shape=(num_states,), dtype=np.float64)
+        transition_counts = np.zeros(shape=(num_states, num_states), dtype=np.float64)
+        log_likelihood = 0
+
+        sparse_emissions = isinstance(emission_matrix, SparseEmissionMatrix)
+        if sparse_emissions:
+            emission_counts = sp.csc_matrix((num_states, num_emissions), dtype=np.float64)
+            emitted_ids, emitted_state_prob = [], []
+            buffered = 0
+        else:
+            emission_counts = np.zeros(shape=(num_states, num_emissions), dtype=np.float64)
+
+        for emitted_seq in emitted_sequences:
+            observation_prob = HMM.__observation_prob(emitted_seq, emission_matrix)
+            forward_prob, scales = HMM.__compute_forward_prob(observation_prob, transition_matrix, priors)
+            bckward_prob = HMM.__compute_backward_prob(observation_prob, transition_matrix, scales)
+
+            # posterior probability of the state at each time step
+            state_prob = forward_prob * bckward_prob
+            prior_counts += state_prob[0]
+            # transition counts summed over time : forward(t, i) * a(i, j) * b(j, o(t + 1))
+            # * backward(t + 1, j) / scale(t + 1)
+            transition_counts += transition_matrix * np.dot(forward_prob[:-1].T,
+                                                            observation_prob[1:] * bckward_prob[1:]
+                                                            / scales[1:, None])
+            log_likelihood += np.sum(np.log(scales))
+
+            if not sparse_emissions:
+                np.add.at(emission_counts.T, emitted_seq, state_prob)
+                continue
+            # buffer the sparse counts and add them up in blocks
+            emitted_ids.append(emitted_seq)
+            emitted_state_prob.append(state_prob)
+            buffered += len(emitted_seq)
+            if buffered * num_states >= SPARSE_COUNT_BUFFER_SIZE:
+                emission_counts = emission_counts + HMM.__sparse_counts(emitted_ids, emitted_state_prob,
+                                                                        emission_matrix.shape)
+                emitted_ids, emitted_state_prob, buffered = [], [], 0
+
+        if sparse_emissions and buffered:
+            emission_counts = emission_counts + HMM.__sparse_counts(emitted_ids, emitted_state_prob,
+                                                                    emission_matrix.shape)
+        return prior_counts, transition_counts, emission_counts, log_likelihood
+
+    @staticmethod
+    def __sparse_counts(emitted_ids, emitted_state_prob, shape):
+        """
+        sum the posterior state probabilities of the emission ids into a sparse count matrix
+        :param emitted_ids: list of emission id sequences
+        :param emitted_state_prob: list of (sequence_len, num_states) posterior state probabilities
+        :param shape: (num_states, num_emissions)
+        """
+        emitted_ids, state_prob = np.concatenate(emitted_ids), np.concatenate(emitted_state_prob)
+        num_states = shape[0]
+        return sp.coo_matrix((state_prob.ravel(), (np.tile(np.arange(num_states), len(emitted_ids)),
+                                                   np.repeat(emitted_ids, num_states))), shape=shape).tocsc()
 
-        transition_matrix = (state_bi_count + self.smoothing) / \
-                            (state_count[:, None] + self.smoothing * self.num_states)
-        emission_matrix = (state_emission_count + self.smoothing) / \
-                          (state_count[:, None] + self.smoothing * self.num_emissions)
+    def __maximize(self, prior_counts, transition_counts, emission_counts, num_sequences, train_prior):
+        """
+        M-step of EM (Baum-Welch), set the smoothed MLE estimates of the parameters
+        from the expected counts
+        """
+        transition_matrix = (transition_counts + self.smoothing) / \
+                            (np.sum(transition_counts, axis=1)[:, None] + self.smoothing * self.num_states)
+        if sp.issparse(emission_counts):
+            emission_matrix = SparseEmissionMatrix(emission_counts, self.smoothing)
+        else:
+            emission_matrix = (emission_counts + self.smoothing) / \
+                              (np.sum(emission_counts, axis=1)[:, None] + self.smoothing * self.num_emissions)
+        self.add_transition_prob(transition_matrix)
+        self.add_emission_prob(emission_matrix)
 
         if train_prior:
-            for state_id in xrange(self.num_states):
-                self.states[state_id].prior = (state_initial[state_id] + self.smoothing) / \
-                                              (len(train_sequences) + self.smoothing * self.num_states)
+            self.priors[:] = (prior_counts + self.smoothing) / (num_sequences + self.smoothing * self.num_states)
 
-        self.add_transition_prob(transition_matrix)
-        self.add_emission_prob(emission_matrix)
+    def __e_step(self, emitted_sequences, pool=None, num_shards=0):
+        """
+        compute the expected counts of the emission id sequences under the current
+        parameters, over the shards of sequences held by the pool workers if a pool
+        is given, the counts of the shards add up to the counts of all the sequences
+        """
+        parameters = (self.transition_matrix, self.emission_matrix, self.priors)
+        if pool is None:
+            return self.expected_counts(emitted_sequences, *parameters)
+
+        shard_counts = pool.map(_expected_counts_worker, [(shard_id,) + parameters
+                                                          for shard_id in xrange(num_shards)])
+        return tuple(sum(counts) for counts in zip(*shard_counts))
 
-    def train_unsupervised(self, emission_sequences, max_iter=100):
+    def train_unsupervised(self, emission_sequences, max_iter=100, train_prior=True, n_jobs=1):
         """
         Train the HMM on the Emission sequence(s) using EM (Baum-Welch),
         time scales probabilities to avoid underflow
 
         :param emission_sequences: a sequence of sequence of emission value,
-        where each sequence is a training emission sequence
+        where each sequence is a training emission sequence, or a SequenceCorpus
         :param max_iter: maximum number of iterations to wait for convergence
+        :param train_prior: train the prior probabilities of the state(s)
+        :param n_jobs: number of processes computing the E-step over shards of the
+        sequences, -1 to use all the cores. The shards are handed to the processes
+        once, each iteration only sends the parameters
         :return:
         """
-        emissions = {}
-        for emission in self.emissions:
-            emissions[emission.value] = emission.em_id
-
-        emitted_sequences = []
-        for emission_seq in emission_sequences:
-            emitted_sequences.append([emissions[em_symbol] for em_symbol in emission_seq])
+        emitted_sequences = list(self.__corpus(emission_sequences))
 
-        transition_matrix = np.ndarray(shape=(self.num_states, self.num_states), dtype=np.float128)
-        emission_matrix = np.ndarray(shape=(self.num_states, self.num_emissions), dtype=np.float128)
+        n_jobs = cpu_count() if n_jobs == -1 else min(n_jobs, len(emitted_sequences))
+        pool, num_shards = None, 0
+        if n_jobs > 1:
+            # deal the sequences round robin so the shards are of similar size
+            shards = [emitted_sequences[shard_id::n_jobs] for shard_id in xrange(n_jobs)]
+            pool, num_shards = Pool(n_jobs, initializer=_init_expected_counts_worker, initargs=(shards,)), n_jobs
 
         transition_matrix_old, emission_matrix_old = None, None
 
         self.iterations = 1
-        while not self.__converged(max_iter, transition_matrix_old, emission_matrix_old):
+        try:
+            while not self.__converged(max_iter, transition_matrix_old, emission_matrix_old):
 
-            print "iteration number -> %d" % self.iterations
+                # the M-step replaces the parameter matrices rather than updating them
+                transition_matrix_old = self.transition_matrix
+                emission_matrix_old = self.emission_matrix
 
-            transition_matrix_old = np.copy(transition_matrix)
-            emission_matrix_old = np.copy(emission_matrix)
+                # E-step of EM algorithm
+                prior_counts, transition_counts, emission_counts, log_likelihood = \
+                    self.__e_step(emitted_sequences, pool, num_shards)
+                print "iteration number -> %d, log likelihood -> %f" % (self.iterations, log_likelihood)
+
+                # M-step of EM algorithm
+                self.__maximize(prior_counts, transition_counts, emission_counts, len(emitted_sequences),
+                                train_prior)
+                self.iterations += 1
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        if self.iterations > 1:
+            # online EM of partial_fit continues from the counts of the last iteration
+            self._expected_counts = (prior_counts, transition_counts, emission_counts, len(emitted_sequences))
+            self._num_updates = 0
+
+    def partial_fit(self, sequences, labelled=True, train_prior=True):
+        """
+        update the HMM with a batch of new sequences.
+        Labelled sequences add their counts to the counts of the sequences seen so far,
+        the parameters are the smoothed MLE estimates of all the sequences seen as with
+        train_supervised on all of them.
+        Unlabelled sequences update the parameters by online (stepwise) EM, the expected
+        counts of the batch under the current parameters are interpolated into running
+        expected counts s = (1 - step) * s + step * s_batch, with step = step_size(k) at
+        update k, and the parameters are re-estimated from s. The parameters must be
+        initialized before the first unlabelled batch. The running counts start from the
+        counts the model was last estimated from, those of the last train_unsupervised or
+        of the labelled sequences seen, or else from the counts the current parameters
+        imply at the size of the first batch, so every batch is blended into the current
+        model.
+        The running counts are not normalized, their magnitude drifts towards the size of
+        the recent batches as (1 - step) decays the earlier counts. A batch much larger
+        (smaller) than the running counts moves the parameters more (less) than its step,
+        and the smoothing weighs more against small counts, so keep the batch sizes similar
+        or scale the step size schedule to them
+        :param sequences: a batch of sequences as taken by train_supervised if labelled
+        else as taken by train_unsupervised, or a SequenceCorpus
+        :param labelled: the sequences carry the observed states
+        :param train_prior: train the prior probabilities of the state(s)
+        :return:
+        """
+        corpus = self.__corpus(sequences, labelled)
+        if labelled:
+            counts = self.__supervised_counts(corpus)
+            if self._supervised_counts is not None:
+                counts = SupervisedCounts(*[total + batch for total, batch in zip(self._supervised_counts, counts)])
+            self._supervised_counts = counts
+            self.__estimate(train_prior)
+            return
+
+        emission_matrix = self.emission_matrix
+        if np.isnan(self.transition_matrix).any() or np.isnan(self.priors).any() or \
+                (not self.sparse_emissions and np.isnan(emission_matrix).any()):
+            raise RuntimeError("initialize the parameters of the HMM before online EM")
+        prior_counts, transition_counts, emission_counts, _ = \
+            self.expected_counts(list(corpus), self.transition_matrix, emission_matrix, self.priors)
+        batch_counts = (prior_counts, transition_counts, emission_counts, len(corpus))
+
+        if self._expected_counts is None:
+            self._expected_counts = self.__initial_expected_counts(batch_counts)
+        step = self.step_size(self._num_updates)
+        self._expected_counts = tuple((1 - step) * total + step * batch
+                                      for total, batch in zip(self._expected_counts, batch_counts))
+        self._num_updates += 1
+        self.__maximize(*(self._expected_counts + (train_prior,)))
+
+    def __initial_expected_counts(self, batch_counts):
+        """
+        running expected counts of online EM to start from, the counts of the labelled
+        sequences seen, or else the counts implied by the current parameters scaled to
+        the expected counts of the first batch
+        :param batch_counts: (prior counts, transition counts, emission counts, number of
+        sequences) of the first batch
+        """
+        if self._supervised_counts is not None:
+            counts = self._supervised_counts
+            return (counts.initial_counts.astype(np.float64), counts.transition_counts.astype(np.float64),
+                    counts.emission_counts.astype(np.float64), counts.num_sequences)
+
+        _, transition_counts, emission_counts, num_sequences = batch_counts
+        transition_totals = np.sum(transition_counts, axis=1)
+        emission_totals = np.asarray(emission_counts.sum(axis=1), dtype=np.float64).ravel()
+        emission_matrix = self.emission_matrix
+        if isinstance(emission_matrix, SparseEmissionMatrix):
+            # rescale the stored counts, the smoothing mass stays implicit
+            with np.errstate(divide='ignore', invalid='ignore'):
+                row_scales = np.where(emission_matrix.totals > 0, emission_totals / emission_matrix.totals, 0)
+            implied_emission_counts = sp.diags(row_scales).dot(emission_matrix.counts).tocsc()
+        else:
+            implied_emission_counts = emission_matrix * emission_totals[:, None]
+        return (self.priors * num_sequences, self.transition_matrix * transition_totals[:, None],
+                implied_emission_counts, num_sequences)
 
-            learning_matrices = []
-            for emitted_seq in emitted_sequences:
-                sequence_len = len(emitted_seq)
+    def __log_parameters(self):
+        """
+        get the log of the transition matrix and the priors, zero probabilities map to -inf
+        """
+        with np.errstate(divide='ignore'):
+            return np.log(self.get_transition_matrix()), np.log(self.get_priors())
 
-                # initialize the learning matrix for the training sequence
-                learning_matrix = np.ndarray(shape=(sequence_len, self.num_states, self.num_states),
-                                             dtype=np.float128)
-                # compute the forward and the backward probability of the sequence
-                # based on current model parameters using Viterbi algorithm
-                forward_prob = self.__compute_forward_prob(emitted_seq)
-                bckward_prob = self.__compute_backward_prob(emitted_seq)
+    def __log_observation_prob(self, emitted_seq):
+        """
+        get the log emission probability of the observed symbol at every time step
+        :param emitted_seq: emission id sequence
+        :return: np.ndarray of shape (sequence_len, num_states)
+        """
+        with np.errstate(divide='ignore'):
+            return np.log(self.__observation_prob(emitted_seq, self.emission_matrix))
 
-                # E-step of EM algorithm
-                for time_seq in xrange(sequence_len):
-                    for (i, j) in itertools.product(xrange(self.num_states), xrange(self.num_states)):
-                        bck_prob = 1 if time_seq == sequence_len - 1 else bckward_prob[j, time_seq + 1]
-                        learning_matrix[time_seq, i, j] = forward_prob[i, time_seq] \
-                                                          * self.states[i].get_transition_prob(j) \
-                                                          * self.states[j].get_emission_prob(emitted_seq[time_seq]) \
-                                                          * bck_prob
-                learning_matrices.append(learning_matrix)
-
-            # M-step of EM algorithm
-            for i in xrange(self.num_states):
-                for j in xrange(self.num_states):
-                    transition_matrix[i, j] = 0
-                    for learning_matrix in learning_matrices:
-                        transition_matrix[i, j] += (np.sum(learning_matrix[:, i, j]) + self.smoothing) /\
-                                                  (np.sum(learning_matrix[:, i, :])
-                                                   + (self.smoothing * self.num_states))
-
-            transition_matrix = (transition_matrix.T / np.sum(transition_matrix, axis=1)).T
-
-            for j in xrange(self.num_states):
-                for k in xrange(self.num_emissions):
-                    emission_matrix[j, k] = 0
-                    for learning_matrix in learning_matrices:
-                        emitted_indices = [_id for _id, emission_id in enumerate(emitted_seq)
-                                           if emission_id == k]
-                        emission_matrix[j, k] += (np.sum(learning_matrix[emitted_indices, :, j])
-                                                  + self.smoothing) / np.sum(learning_matrix[:, :, j]) \
-                                                 + (self.smoothing * self.num_emissions)
-
-            emission_matrix = (emission_matrix.T / np.sum(emission_matrix, axis=1)).T
-
-            print "emission_matrix", emission_matrix
-            print "transition_matrix", transition_matrix
-
-            print "-------------------------------------"
-            self.add_emission_prob(emission_matrix)
-            self.add_transition_prob(transition_matrix)
-
-            self.iterations += 1
+    @staticmethod
+    def __viterbi(log_observation_prob, log_transitions, log_priors):
+        """
+        find the most likely state sequence by the Viterbi algorithm in log space
+        :param log_observation_prob: (sequence_len, num_states) log emission probabilities
+        of the observed symbols
+        :param log_transitions: (num_states, num_states) log transition probabilities
+        :param log_priors: (num_states,) log prior probabilities of the states
+        :return: (state id sequence, joint log likelihood of the sequence and the states,
+        (sequence_len, num_states) log probability of the best path ending in each state),
+        an empty sequence has an empty state sequence and a log likelihood of 0
+        """
+        sequence_len, num_states = log_observation_prob.shape
+        scores = np.empty(shape=(sequence_len, num_states), dtype=np.float64)
+        if sequence_len == 0:
+            return np.empty(shape=(0,), dtype=np.int32), 0.0, scores
+        backpointers = np.zeros(shape=(sequence_len, num_states), dtype=np.int32)
+        state_ids = np.arange(num_states)
+
+        scores[0] = log_priors + log_observation_prob[0]
+        for time_seq in xrange(1, sequence_len):
+            # candidates[i, j] is the score of reaching state j from state i
+            candidates = scores[time_seq - 1][:, None] + log_transitions
+            backpointers[time_seq] = np.argmax(candidates, axis=0)
+            scores[time_seq] = candidates[backpointers[time_seq], state_ids] + log_observation_prob[time_seq]
+
+        state_sequence = np.empty(shape=(sequence_len,), dtype=np.int32)
+        state_sequence[-1] = np.argmax(scores[-1])
+        for time_seq in xrange(sequence_len - 1, 0, -1):
+            state_sequence[time_seq - 1] = backpointers[time_seq, state_sequence[time_seq]]
+        return state_sequence, scores[-1, state_sequence[-1]], scores
+
+    @staticmethod
+    def __viterbi_batch(log_observation_prob, sequence_lens, log_transitions, log_priors):
+        """
+        Viterbi algorithm over a batch of sequences padded to the same length
+        :param log_observation_prob: (num_sequences, max_sequence_len, num_states) log emission
+        probabilities of the observed symbols, the values past the end of a sequence are ignored
+        :param sequence_lens: (num_sequences,) length of each sequence
+        :param log_transitions: (num_states, num_states) log transition probabilities
+        :param log_priors: (num_states,) log prior probabilities of the states
+        :return: ((num_sequences, max_sequence_len) state id sequences padded with -1,
+        (num_sequences,) joint log likelihood of each sequence and its states, 0 for an
+        empty sequence)
+        """
+        num_sequences, max_sequence_len, num_states = log_observation_prob.shape
+        if max_sequence_len == 0:
+            return np.empty(shape=(num_sequences, 0), dtype=np.int32), np.zeros(num_sequences)
+        backpointers = np.empty(shape=(num_sequences, max_sequence_len, num_states), dtype=np.int32)
+        backpointers[:, 0] = np.arange(num_states)
+        sequence_ids = np.arange(num_sequences)
+
+        scores = log_priors + log_observation_prob[:, 0]
+        for time_seq in xrange(1, max_sequence_len):
+            candidates = scores[:, :, None] + log_transitions
+            best = np.argmax(candidates, axis=1)
+            active = (time_seq < sequence_lens)[:, None]
+            # finished sequences keep their scores and point back to the same state
+            scores = np.where(active, np.max(candidates, axis=1) + log_observation_prob[:, time_seq], scores)
+            backpointers[:, time_seq] = np.where(active, best, backpointers[:, 0])
+
+        state_sequences = np.empty(shape=(num_sequences, max_sequence_len), dtype=np.int32)
+        state_sequences[:, -1] = np.argmax(scores, axis=1)
+        log_likelihoods = scores[sequence_ids, state_sequences[:, -1]]
+        for time_seq in xrange(max_sequence_len - 1, 0, -1):
+            state_sequences[:, time_seq - 1] = backpointers[sequence_ids, time_seq, state_sequences[:, time_seq]]
+        state_sequences[np.arange(max_sequence_len)[None, :] >= sequence_lens[:, None]] = -1
+        # the scores of an empty sequence come from the padding, it has probability 1
+        log_likelihoods[sequence_lens == 0] = 0
+        return state_sequences, log_likelihoods
 
     def predict(self, emission_sequences):
         """
         predict the most likely sequence of states for the emission sequence
         :param emission_sequences: list of emission sequence(s) to predict the
-        best states sequence on
+        best states sequence on, or a SequenceCorpus
         :return: sequence of (sequence of optimal HMMState assingment for the emission sequence,
-        forward probability matrix)
+        (num_states, sequence_len) log probability of the best path ending in each state
+        at each time step, joint log likelihood of the emission sequence and the assignment)
         """
-        emissions = {}
-        for emission in self.emissions:
-            emissions[emission.value] = emission.em_id
-
+        log_transitions, log_priors = self.__log_parameters()
         optimal_assignments = []
 
-        for emission_seq in emission_sequences:
-            emitted_seq = [emissions[val] for val in emission_seq]
-            sequence_len = len(emitted_seq)
+        for emitted_seq in self.__corpus(emission_sequences):
+            state_sequence, log_likelihood, scores = \
+                self.__viterbi(self.__log_observation_prob(emitted_seq), log_transitions, log_priors)
 
-            forward_prob = np.ndarray(shape=(self.num_states, sequence_len), dtype=np.float128)
-            optimal_state_sequence = [None] * sequence_len
+            optimal_assignment = OptimalAssignment(optimal_state_sequence=[self.states[state_id]
+                                                                           for state_id in state_sequence],
+                                                   forward_prob_matrix=scores.T,
+                                                   log_likelihood=log_likelihood)
+            optimal_assignments.append(optimal_assignment)
+        return optimal_assignments
 
-            for i in range(self.num_states):
-                forward_prob[i, 0] = self.states[i].prior * self.states[i].get_emission_prob(emitted_seq[0])
+    def predict_batch(self, emission_sequences):
+        """
+        predict the most likely sequence of states for many emission sequences at once,
+        the sequences are padded into one array and decoded together
+        :param emission_sequences: list of emission sequence(s) to predict the
+        best states sequence on, or a SequenceCorpus
+        :return: ((num_sequences, max_sequence_len) array of the optimal state ids of each
+        sequence padded with -1, (num_sequences,) array of the joint log likelihood of each
+        emission sequence and its assignment)
+        """
+        log_transitions, log_priors = self.__log_parameters()
+        observation_prob, sequence_lens = self.__padded_observation_prob(emission_sequences)
+        with np.errstate(divide='ignore'):
+            log_observation_prob = np.log(observation_prob)
+        return self.__viterbi_batch(log_observation_prob, sequence_lens, log_transitions, log_priors)
 
-            optimal_state_sequence[0] = self.states[np.argmax(forward_prob[:, 0])]
+    def __padded_observation_prob(self, emission_sequences):
+        """
+        get the emission probabilities of the observed symbols of many sequences padded
+        to the length of the longest, the padding holds the probabilities of emission id 0
+        :return: ((num_sequences, max_sequence_len, num_states) emission probabilities,
+        (num_sequences,) length of each sequence)
+        """
+        emitted_seqs, sequence_lens = self.__corpus(emission_sequences).padded()
+        observation_prob = self.__observation_prob(emitted_seqs.ravel(), self.emission_matrix) \
+            .reshape(emitted_seqs.shape + (self.num_states,))
+        return observation_prob, sequence_lens
 
-            for time_seq in xrange(1, sequence_len):
-                for j in xrange(self.num_states):
-                    optimal_state_sequence[time_seq], forward_prob[j, time_seq] = \
-                        max([(self.states[i], np.exp(np.log(forward_prob[i, time_seq - 1]) +
-                                                     np.log(self.states[i].get_transition_prob(j)) +
-                                                     np.log(self.states[j].get_emission_prob(emitted_seq[time_seq]))))
-                                                     for i in xrange(self.num_states)], key=lambda e: e[1])
+    @staticmethod
+    def __forward_backward_batch(observation_prob, sequence_lens, transition_matrix, priors):
+        """
+        scaled forward-backward over a batch of sequences padded to the same length
+        :param observation_prob: (num_sequences, max_sequence_len, num_states) emission
+        probabilities of the observed symbols, the values past the end of a sequence are ignored
+        :param sequence_lens: (num_sequences,) length of each sequence
+        :param transition_matrix: (num_states, num_states) transition probabilities
+        :param priors: (num_states,) prior probabilities of the states
+        :return: ((num_sequences, max_sequence_len, num_states) posterior probabilities of the
+        states, 0 past the end of a sequence, (num_sequences,) log likelihood of each sequence)
+        """
+        num_sequences, max_sequence_len, num_states = observation_prob.shape
+        if max_sequence_len == 0:
+            return np.zeros(shape=observation_prob.shape), np.zeros(num_sequences)
+        active = np.arange(max_sequence_len)[None, :] < sequence_lens[:, None]
+        forward_prob = np.empty(shape=observation_prob.shape, dtype=np.float64)
+        bckward_prob = np.empty(shape=observation_prob.shape, dtype=np.float64)
+        # the scale factors past the end of a sequence are 1
+        scales = np.ones(shape=(num_sequences, max_sequence_len), dtype=np.float64)
+
+        forward_prob[:, 0] = priors * observation_prob[:, 0]
+        for time_seq in xrange(max_sequence_len):
+            if time_seq > 0:
+                forward_prob[:, time_seq] = np.dot(forward_prob[:, time_seq - 1], transition_matrix) \
+                                            * observation_prob[:, time_seq]
+            scales[active[:, time_seq], time_seq] = np.sum(forward_prob[active[:, time_seq], time_seq], axis=1)
+            forward_prob[:, time_seq] /= scales[:, time_seq, None]
+
+        bckward_prob[:, max_sequence_len - 1] = 1
+        for time_seq in xrange(max_sequence_len - 2, -1, -1):
+            bckward_prob[:, time_seq] = np.where(
+                active[:, time_seq + 1, None],
+                np.dot(observation_prob[:, time_seq + 1] * bckward_prob[:, time_seq + 1], transition_matrix.T)
+                / scales[:, time_seq + 1, None], 1)
+
+        state_prob = forward_prob * bckward_prob
+        state_prob[~active] = 0
+        return state_prob, np.sum(np.log(scales), axis=1)
+
+    def posterior_marginals(self, emission_sequences):
+        """
+        compute the posterior probability of every state at every time step of many
+        emission sequences at once by forward-backward, the sequences are padded into
+        one array and processed together
+        :param emission_sequences: list of emission sequence(s), or a SequenceCorpus
+        :return: ((num_sequences, max_sequence_len, num_states) array of the posterior
+        probabilities of the states padded with 0, (num_sequences,) array of the log
+        likelihood of each emission sequence)
+        """
+        observation_prob, sequence_lens = self.__padded_observation_prob(emission_sequences)
+        return self.__forward_backward_batch(observation_prob, sequence_lens, self.get_transition_matrix(),
+                                             self.get_priors())
 
-            optimal_assignment = OptimalAssignment(optimal_state_sequence=optimal_state_sequence,
-                                                   forward_prob_matrix=forward_prob)
-            optimal_assignments.append(optimal_assignment)
-        return optimal_assignments
+    @staticmethod
+    def __list_viterbi_batch(log_observation_prob, sequence_lens, log_transitions, log_priors, n_best):
+        """
+        list Viterbi algorithm over a batch of sequences padded to the same length, keeps
+        the n_best best partial paths ending in each state at each time step
+        :param log_observation_prob: (num_sequences, max_sequence_len, num_states) log emission
+        probabilities of the observed symbols, the values past the end of a sequence are ignored
+        :param sequence_lens: (num_sequences,) length of each sequence
+        :param log_transitions: (num_states, num_states) log transition probabilities
+        :param log_priors: (num_states,) log prior probabilities of the states
+        :param n_best: number of paths to find
+        :return: ((num_sequences, n_best, max_sequence_len) state id sequences padded with -1,
+        (num_sequences, n_best) joint log likelihood of each sequence and each path, paths
+        that do not exist are all -1 with a log likelihood of -inf, an empty sequence has
+        the one empty path with a log likelihood of 0)
+        """
+        num_sequences, max_sequence_len, num_states = log_observation_prob.shape
+        if max_sequence_len == 0:
+            log_likelihoods = np.full((num_sequences, n_best), -np.inf)
+            log_likelihoods[:, 0] = 0
+            return np.empty(shape=(num_sequences, n_best, 0), dtype=np.int32), log_likelihoods
+        # a path is a (state, rank) pair, flattened as state * n_best + rank
+        paths = np.arange(num_states * n_best).reshape(num_states, n_best)
+        backpointers = np.empty(shape=(num_sequences, max_sequence_len, num_states, n_best), dtype=np.int32)
+        backpointers[:, 0] = paths
+        sequence_ids = np.arange(num_sequences)
+
+        scores = np.full((num_sequences, num_states, n_best), -np.inf)
+        scores[:, :, 0] = log_priors + log_observation_prob[:, 0]
+        for time_seq in xrange(1, max_sequence_len):
+            # candidates[b, j, i * n_best + r] is the score of reaching state j from path (i, r)
+            candidates = (scores[:, :, None, :] + log_transitions[None, :, :, None]) \
+                .transpose(0, 2, 1, 3).reshape(num_sequences, num_states, num_states * n_best)
+            best = np.argsort(-candidates, axis=2, kind='mergesort')[:, :, :n_best]
+            active = (time_seq < sequence_lens)[:, None, None]
+            # finished sequences keep their scores and point back to the same paths
+            scores = np.where(active, np.take_along_axis(candidates, best, axis=2)
+                              + log_observation_prob[:, time_seq, :, None], scores)
+            backpointers[:, time_seq] = np.where(active, best, paths)
+
+        final = np.argsort(-scores.reshape(num_sequences, -1), axis=1, kind='mergesort')[:, :n_best]
+        log_likelihoods = scores.reshape(num_sequences, -1)[sequence_ids[:, None], final]
+
+        state_sequences = np.empty(shape=(num_sequences, n_best, max_sequence_len), dtype=np.int32)
+        for time_seq in xrange(max_sequence_len - 1, -1, -1):
+            state_sequences[:, :, time_seq] = final // n_best
+            final = backpointers[sequence_ids[:, None], time_seq, final // n_best, final % n_best]
+        state_sequences[np.broadcast_to(np.arange(max_sequence_len) >= sequence_lens[:, None, None],
+                                        state_sequences.shape)] = -1
+        # the scores of an empty sequence come from the padding, its only path is the empty one
+        empty = sequence_lens == 0
+        log_likelihoods[empty] = -np.inf
+        log_likelihoods[empty, 0] = 0
+        state_sequences[np.isneginf(log_likelihoods)] = -1
+        return state_sequences, log_likelihoods
+
+    def predict_nbest(self, emission_sequences, n_best=5):
+        """
+        find the n_best most likely state sequences of many emission sequences at once by
+        list Viterbi decoding, the sequences are padded into one array and decoded together
+        :param emission_sequences: list of emission sequence(s), or a SequenceCorpus
+        :param n_best: number of state sequences to find for each emission sequence
+        :return: ((num_sequences, n_best, max_sequence_len) array of the state ids of the
+        best paths of each sequence, best first, padded with -1, (num_sequences, n_best) array
+        of the joint log likelihood of each emission sequence and path, paths that do not
+        exist are all -1 with a log likelihood of -inf)
+        """
+        log_transitions, log_priors = self.__log_parameters()
+        observation_prob, sequence_lens = self.__padded_observation_prob(emission_sequences)
+        with np.errstate(divide='ignore'):
+            log_observation_prob = np.log(observation_prob)
+        return self.__list_viterbi_batch(log_observation_prob, sequence_lens, log_transitions, log_priors,
+                                         n_best)
+
+    def save(self, path):
+        """
+        save the model to the directory path, one .npy file per parameter array, a
+        json file of the model parameters and a pickle of the symbol tables of the states
+        and the emissions, see load. A sparse emission matrix is saved as its CSC arrays.
+        The counts kept for partial_fit are not saved
+        :param path: directory to save the model to
+        """
+        arrays = {'transition_matrix': self.get_transition_matrix(), 'priors': self.get_priors()}
+        emission_matrix = self.get_emission_matrix()
+        if self.sparse_emissions:
+            arrays['emission_data'] = emission_matrix.counts.data
+            arrays['emission_indices'] = emission_matrix.counts.indices
+            arrays['emission_indptr'] = emission_matrix.counts.indptr
+            emission_smoothing = emission_matrix.smoothing
+        else:
+            arrays['emission_matrix'] = emission_matrix
+            emission_smoothing = None
+
+        params = {'smoothing': self.smoothing, 'tolerance': self.tolerance,
+                  'sparse_emissions': self.sparse_emissions}
+        save_arrays(path, arrays, {'model': 'HMM', 'params': params,
+                                   'emission_smoothing': emission_smoothing})
+        with open(os.path.join(path, SYMBOLS_FILE), 'wb') as symbols_file:
+            pickle.dump({'states': [state.state_name for state in self.states],
+                         'emissions': [emission.value for emission in self.emissions]},
+                        symbols_file, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """
+        load a model saved with save, by default the arrays are memory mapped read only
+        so several processes decoding with the model share one copy of the parameters,
+        load with mmap_mode=None or "c" to change or train the model
+        :param path: directory the model was saved to
+        :param mmap_mode: memory map mode of the arrays as in numpy.load
+        :return: HMM instance
+        """
+        arrays, meta = load_arrays(path, mmap_mode)
+        if meta.get('model') != 'HMM':
+            raise RuntimeError("no saved HMM model found at :%s" % path)
+        model = cls(**meta['params'])
+        with open(os.path.join(path, SYMBOLS_FILE), 'rb') as symbols_file:
+            symbols = pickle.load(symbols_file)
+
+        model.states = [HMMState(model, state_id, name) for state_id, name in enumerate(symbols['states'])]
+        model.emissions = [HMMEmission(em_id=em_id, value=value) for em_id, value in enumerate(symbols['emissions'])]
+        model.num_states, model.num_emissions = len(model.states), len(model.emissions)
+        model._state_index = dict((state.state_name, state.state_id) for state in model.states)
+        model._emission_index = dict((emission.value, emission.em_id) for emission in model.emissions)
+
+        model._transition_matrix, model._priors = arrays['transition_matrix'], arrays['priors']
+        if model.sparse_emissions:
+            counts = sp.csc_matrix((arrays['emission_data'], arrays['emission_indices'],
+                                    arrays['emission_indptr']), shape=(model.num_states, model.num_emissions))
+            model._emission_matrix = SparseEmissionMatrix(counts, meta['emission_smoothing'])
+        else:
+            model._emission_matrix = arrays['emission_matrix']
+        return model
+
+
+# shards of emission id sequences of a pool worker process of train_unsupervised
+_worker_shards = None
+
+
+def _init_expected_counts_worker(shards):
+    global _worker_shards
+    _worker_shards = shards
+
+
+def _expected_counts_worker(args):
+    """
+    compute the expected counts of a shard of sequences in a pool worker process
+    :param args: (shard id, transition matrix, emission matrix, priors)
+    """
+    shard_id, transition_matrix, emission_matrix, priors = args
+    return HMM.expected_counts(_worker_shards[shard_id], transition_matrix, emission_matrix, priors)
@@ -1,15 +1,18 @@
 import graphical_models.hmm as hmm_model
 import numpy as np
+import scipy.sparse as sp
+
+SPARSE_INIT_ENTRIES = 100
 
 
 class HMMHelper:
     """
     class to help creating hmm instances
     """
-    def __init__(self, num_states, num_emissions):
+    def __init__(self, num_states, num_emissions, sparse_emissions=False):
         self.__num_states = num_states
         self.__num_emissions = num_emissions
-        self.hmm_model = hmm_model.HMM()
+        self.hmm_model = hmm_model.HMM(sparse_emissions=sparse_emissions)
 
     def create_hmm(self, state_symbols, emission_symbols, priors=None, init_prob_matrix=True):
         """
@@ -38,9 +41,16 @@ class HMMHelper:
         transition_matrix = np.random.rand(self.__num_states, self.__num_states)
         transition_matrix = (transition_matrix.T / np.sum(transition_matrix, axis=1)).T
 
-        # random initialize a valid emission matrix
-        emission_matrix = np.random.rand(self.__num_states, self.__num_emissions)
-        emission_matrix = (emission_matrix.T / np.sum(emission_matrix, axis=1)).T
+        # random initialize a valid emission matrix, a sparse one holds random counts for
+        # about SPARSE_INIT_ENTRIES emissions of every state, the rest are smoothed
+        if self.hmm_model.sparse_emissions:
+            density = min(1., float(SPARSE_INIT_ENTRIES) / self.__num_emissions)
+            emission_matrix = hmm_model.SparseEmissionMatrix(
+                sp.random(self.__num_states, self.__num_emissions, density=density),
+                self.hmm_model.smoothing)
+        else:
+            emission_matrix = np.random.rand(self.__num_states, self.__num_emissions)
+            emission_matrix = (emission_matrix.T / np.sum(emission_matrix, axis=1)).T
 
         self.hmm_model.add_transition_prob(transition_matrix)
         self.hmm_model.add_emission_prob(emission_matrix)
@@ -1,31 +1,72 @@
 from __future__ import division
-from itertools import izip
+import itertools as it
+
 import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.linalg import lsqr
+
+from regression.optimizers import get_optimizer
+
+
+SOLVERS = ('batch', 'sgd', 'lstsq', 'normal')
+
+# number of rows predict scores per matrix product
+PREDICT_CHUNK_SIZE = 65536
+
+# stopping tolerance of the lsqr solves of sparse inputs
+LSQR_TOLERANCE = 1e-10
 
 
 class LinearRegression:
     """
-    Linear regression with batch gradient descent 
+    Linear regression fit by batch gradient descent, mini-batch stochastic
+    gradient descent, or in closed form. The inputs X may be scipy sparse
+    matrices, they are used in CSR form and the time and memory of fitting
+    and predicting scale with their number of non zeros
     """
 
-    def __init__(self, learning_rate=0.001, max_iterations=1000):
+    def __init__(self, learning_rate=0.001, max_iterations=1000, sgd_tolerance=1e-3, patience=5):
+        """
+        @param sgd_tolerance : relative decrease of the epoch loss of sgd that counts
+                               as an improvement
+        @param patience      : number of epochs of sgd without improvement to converge
+        """
         self.alpha = learning_rate
         self.max_iter = max_iterations
         self.convergance_factor = 1e-07
+        self.sgd_tolerance = sgd_tolerance
+        self.patience = patience
 
-    def fit(self, X_train, Y_train, sgd=False):
+    def fit(self, X_train, Y_train, sgd=False, solver=None, batch_size=32, optimizer='sgd'):
         """
         Fit a linear regression model on the training set 
-        using batch gradient descent and store the model 
+        and store the model 
         
-        @param X_train  : training set X 
-        @param Y_traing : training set Y 
-        @param SGD      : Apply stochastic gradient descent 
+        @param X_train    : training set X, a numpy array or a scipy sparse matrix
+        @param Y_traing   : training set Y 
+        @param SGD        : Apply stochastic gradient descent, same as solver="sgd"
+        @param solver     : "batch" for batch gradient descent (the default), "sgd" for
+                            mini-batch stochastic gradient descent, "lstsq" for the least
+                            squares solution of X w = Y, "normal" for the solution of the
+                            normal equations X^T X w = X^T Y, which is faster than lstsq
+                            for many more samples than features but less accurate when
+                            X^T X is ill conditioned. For sparse X both are solved
+                            iteratively by lsqr, lstsq on X and normal on the sparse X^T X
+        @param batch_size : number of examples in a mini-batch of sgd
+        @param optimizer  : descent step of the batch and sgd solvers, "sgd", "momentum",
+                            "adagrad" or "adam" with the learning rate of the model, or an
+                            Optimizer of regression.optimizers
         """
         if type(X_train) == list:
             X_train = np.asarray(X_train)
+        if sp.issparse(X_train):
+            X_train = X_train.tocsr()
         if type(Y_train) == list:
             Y_train = np.asarray(Y_train)
+        if solver is None:
+            solver = 'sgd' if sgd else 'batch'
+        if solver not in SOLVERS:
+            raise RuntimeError("solver must be one of %s" % ", ".join(SOLVERS))
 
         self.X_train, self.Y_train = X_train, Y_train
         self.num_samples, self.num_features = self.X_train.shape
@@ -34,103 +75,260 @@ class LinearRegression:
         if self.num_outputs != self.num_samples:
             raise RuntimeError("Y_train must be of shape of (X_train[0], )")
 
-        # initilize the model params with uniform distribution in [0,1]
-        self.model = np.reshape(np.random.rand(self.num_features + 1), (self.num_features + 1, 1))
+        self.iterations = 0
+        if solver == 'lstsq':
+            self.model = self.__lstsq(self.X_train, self.Y_train)
+            return
+        if solver == 'normal':
+            self.model = self.__normal_solve(*self.__normal_matrices(self.X_train, self.Y_train))
+            return
 
-        train_algo = self.__batch_train if not sgd else self.__stochastic_train
+        self.__init_model()
+        self.batch_size = batch_size
+        self.optimizer = get_optimizer(optimizer, self.alpha)
+
+        self.solver = solver
+        train_algo = self.__batch_train if solver == 'batch' else self.__stochastic_train
 
-        self.iterations = 0
         while not self.__convergence():
-            train_algo()
+            train_algo([(self.X_train, self.Y_train)])
 
-    def __batch_train(self):
+    def fit_stream(self, chunks, solver='normal', batch_size=32, optimizer='sgd'):
         """
-        batch mode of training, batch gradient descent
+        Fit a linear regression model on a training set streamed in chunks, so only
+        one chunk is in memory at a time, e.g. chunks read from np.memmap files.
+        The normal solver accumulates X^T X and X^T Y over one pass of the chunks and
+        solves the normal equations exactly, the batch and sgd solvers make passes
+        over the chunks until convergence
+        
+        @param chunks     : iterable of (X_chunk, Y_chunk) blocks of the training set, or
+                            a function returning a new iterator of the blocks. The batch
+                            and sgd solvers make more than one pass, they need a function
+                            or a re-iterable such as a list, a pass over an exhausted
+                            iterator raises a RuntimeError
+        @param solver     : "normal", "batch" or "sgd", see fit
+        @param batch_size : number of examples in a mini-batch of sgd
+        @param optimizer  : descent step of the batch and sgd solvers, see fit
         """
-        self.old_model = np.copy(self.model)
-        for index, theta in enumerate(self.old_model):
+        if solver not in ('batch', 'sgd', 'normal'):
+            raise RuntimeError("solver must be one of batch, sgd, normal")
+        chunk_pass = lambda: iter(chunks() if callable(chunks) else chunks)
 
-            gradient = 0
-            for train_example, target in izip(self.X_train, self.Y_train):
-                model_at_example = np.dot(train_example, self.old_model[:-1]) + self.old_model[self.num_features]
-                # non bias input
-                if index < self.num_features:
-                    gradient += ((target - model_at_example) * train_example[index])
-                else:
-                    gradient += (target - model_at_example)
+        # the training set is not held, only the chunk being processed
+        self.X_train, self.Y_train = None, None
+        self.iterations, self.num_features = 0, None
 
-            theta = theta + gradient * self.alpha
-            self.model[index][0] = theta
-        print self.model
+        first_pass = chunk_pass()
+        try:
+            X_chunk, Y_chunk = self.__check_chunk(*next(first_pass))
+        except StopIteration:
+            raise RuntimeError("no training chunks to fit")
+        self.num_features = X_chunk.shape[1]
+        first_pass = it.chain([(X_chunk, Y_chunk)], first_pass)
+
+        if solver == 'normal':
+            gram, moments = 0, 0
+            self.num_samples = 0
+            for X_chunk, Y_chunk in first_pass:
+                chunk_gram, chunk_moments = self.__normal_matrices(*self.__check_chunk(X_chunk, Y_chunk))
+                gram = gram + chunk_gram
+                moments = moments + chunk_moments
+                self.num_samples += X_chunk.shape[0]
+            self.model = self.__normal_solve(gram, moments)
+            return
+
+        self.__init_model()
+        self.batch_size = batch_size
+        self.optimizer = get_optimizer(optimizer, self.alpha)
+
+        self.solver = solver
+        train_algo = self.__batch_train if solver == 'batch' else self.__stochastic_train
 
-    def __stochastic_train(self, learning_rate_delta=False):
+        while not self.__convergence():
+            train_algo(it.starmap(self.__check_chunk, first_pass if self.iterations == 0 else chunk_pass()))
+
+    def __check_chunk(self, X, Y):
         """
-        stochastic model of training, a.k.a SGD
-        @param learning_rate_delta : Whether to vary the learning rate with iterations 
+        check a (X, Y) block of training examples, return it as numpy arrays,
+        or a CSR matrix and a numpy array for a sparse X
         """
-        for train_example, target in izip(self.X_train, self.Y_train):
+        X, Y = X.tocsr() if sp.issparse(X) else np.asarray(X), np.asarray(Y)
+        if X.ndim != 2 or Y.shape != (X.shape[0],):
+            raise RuntimeError("Y_chunk must be of shape of (X_chunk[0], )")
+        if self.num_features is not None and X.shape[1] != self.num_features:
+            raise RuntimeError("chunk feature space size does not match the first chunk")
+        return X, Y
 
-            last_gradient_update, cache = 0, 1
-            self.old_model = np.copy(self.model)
-            model_at_example = np.dot(train_example, self.old_model[:-1]) + self.old_model[self.num_features]
-            for index, theta in enumerate(self.old_model):
-                # non bias input
-                if index < self.num_features:
-                    gradient = ((target - model_at_example) * train_example[index])
-                else:
-                    gradient = (target - model_at_example)
+    def __init_model(self):
+        """
+        initilize the model params with uniform distribution in [0,1]
+        """
+        self.model = np.reshape(np.random.rand(self.num_features + 1), (self.num_features + 1, 1))
+        self.old_loss, self.loss = None, None
+        self.best_loss, self.epochs_no_improvement = None, 0
+
+    @staticmethod
+    def __with_bias(X):
+        """
+        append the bias input, a column of ones, to X
+        """
+        if sp.issparse(X):
+            return sp.hstack((X, np.ones(shape=(X.shape[0], 1), dtype=X.dtype)), format='csr')
+        return np.hstack((X, np.ones(shape=(X.shape[0], 1), dtype=X.dtype)))
 
-                theta = theta + (gradient * (self.alpha / np.sqrt(cache + 1e-08)))
-                last_gradient_update += (gradient * gradient)
-                self.model[index][0] = theta
-            cache = last_gradient_update
+    def __lstsq(self, X, Y):
+        """
+        closed form least squares solution, the model params minimizing the squared loss
+        """
+        if sp.issparse(X):
+            model = lsqr(self.__with_bias(X), Y, atol=LSQR_TOLERANCE, btol=LSQR_TOLERANCE)[0]
+            return np.reshape(model, (self.num_features + 1, 1))
+        model, _, _, _ = np.linalg.lstsq(self.__with_bias(X), Y, rcond=None)
+        return np.reshape(model, (self.num_features + 1, 1))
+
+    def __normal_matrices(self, X, Y):
+        """
+        the normal matrix X^T X and the moments X^T Y of the examples X, Y with the
+        bias input appended to X, they add up over blocks of examples, the normal
+        matrix of a sparse X is sparse
+        """
+        X = self.__with_bias(X)
+        return X.T.dot(X), X.T.dot(Y)
+
+    def __normal_solve(self, gram, moments):
+        """
+        closed form solution of the normal equations, lstsq of the (d + 1, d + 1)
+        normal matrix so a singular one still gets the minimum norm solution
+        """
+        if sp.issparse(gram):
+            model = lsqr(gram, moments, atol=LSQR_TOLERANCE, btol=LSQR_TOLERANCE)[0]
+            return np.reshape(model, (self.num_features + 1, 1))
+        model, _, _, _ = np.linalg.lstsq(gram, moments, rcond=None)
+        return np.reshape(model, (self.num_features + 1, 1))
 
-            # update the cache to be as in Adagrad updated to
-            print self.model
+    def __gradient(self, X, Y):
+        """
+        gradient of the squared loss 1/2 * sum((X w + b - Y) ^ 2) over the examples
+        X, Y with respect to the model params, bias last, and the loss
+        """
+        residual = X.dot(self.model[:-1, 0]) + self.model[-1, 0] - Y
+        gradient = np.empty(shape=(self.num_features + 1,))
+        gradient[:-1] = X.T.dot(residual)
+        gradient[-1] = np.sum(residual)
+        return gradient, 0.5 * np.dot(residual, residual)
 
-    def predict(self, test_X):
+    def __sparse_gradient(self, X, Y):
+        """
+        gradient of the squared loss over the examples of a CSR matrix X, Y with
+        respect to the model params of the features present in X and the bias,
+        so a mini-batch update costs time in the non zeros of the mini-batch
+        rather than in the number of features
+        :return: (gradient, indices of the params of the gradient, loss)
+        """
+        residual = X.dot(self.model[:-1, 0]) + self.model[-1, 0] - Y
+        row_ids = np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))
+        indices, feature_ids = np.unique(X.indices, return_inverse=True)
+        gradient = np.empty(shape=(len(indices) + 1,))
+        gradient[:-1] = np.bincount(feature_ids, weights=X.data * residual[row_ids], minlength=len(indices))
+        gradient[-1] = np.sum(residual)
+        return gradient, np.append(indices, self.num_features), 0.5 * np.dot(residual, residual)
+
+    def __batch_train(self, chunks):
+        """
+        batch mode of training, batch gradient descent, the gradient is summed
+        over the (X, Y) chunks of the training set
         """
-        predict the Y for the X_test based on the computed model
+        self.old_loss, self.loss = self.loss, 0
+        gradient = np.zeros(shape=(self.num_features + 1,))
+        num_samples = 0
+        for X, Y in chunks:
+            chunk_gradient, chunk_loss = self.__gradient(X, Y)
+            gradient += chunk_gradient
+            self.loss += chunk_loss
+            num_samples += X.shape[0]
+        self.__check_epoch(num_samples)
+        self.optimizer.update(self.model[:, 0], gradient)
+
+    def __stochastic_train(self, chunks):
+        """
+        stochastic model of training, a.k.a SGD, one epoch of mini-batch updates
+        over the (X, Y) chunks of the training set, in random order within a chunk
+        """
+        self.old_loss, self.loss = self.loss, 0
+        epoch_samples = 0
+        for X, Y in chunks:
+            num_samples = X.shape[0]
+            epoch_samples += num_samples
+            order = np.random.permutation(num_samples)
+            for start in xrange(0, num_samples, self.batch_size):
+                batch = order[start:start + self.batch_size]
+                if sp.issparse(X):
+                    gradient, indices, loss = self.__sparse_gradient(X[batch], Y[batch])
+                else:
+                    (gradient, loss), indices = self.__gradient(X[batch], Y[batch]), None
+                self.optimizer.update(self.model[:, 0], gradient, indices)
+                self.loss += loss
+        self.__check_epoch(epoch_samples)
+
+    def __check_epoch(self, num_samples):
+        """
+        an epoch over no training examples, e.g. a second pass over an exhausted
+        generator of chunks, must not pass for convergence
+        """
+        if num_samples == 0:
+            raise RuntimeError("an epoch saw no training examples, pass fit_stream a function "
+                               "returning a new iterator of the chunks for more than one pass")
+
+    def predict(self, test_X, chunk_size=PREDICT_CHUNK_SIZE):
+        """
+        predict the Y for the X_test based on the computed model, one matrix
+        product per chunk of rows so a large or memory mapped test set is not
+        copied as a whole
         
-        @param  test_X : test set X
-        @return predicted Y value for each x in X as list
+        @param  test_X     : test set X, a numpy array or a scipy sparse matrix
+        @param  chunk_size : number of rows scored per matrix product
+        @return predicted Y value for each x in X as numpy array
         """
         if type(test_X) == list: test_X = np.asarray(test_X)
+        if sp.issparse(test_X): test_X = test_X.tocsr()
         num_samples, num_features = test_X.shape
 
-        test_Y = np.ndarray(shape=(num_samples,))
         if num_features + 1 != self.model.shape[0]:
             raise RuntimeError("test set feature space size does not match model")
 
-        transposed_model = np.transpose(self.model[:-1])
-        for index, test_input in enumerate(test_X):
-            predicted = np.dot(transposed_model, test_input) + self.model[-1:]
-            test_Y[index] = predicted
-
+        test_Y = np.empty(shape=(num_samples,))
+        weights, bias = self.model[:-1, 0], self.model[-1, 0]
+        for start in xrange(0, num_samples, chunk_size):
+            if sp.issparse(test_X):
+                test_Y[start:start + chunk_size] = test_X[start:start + chunk_size].dot(weights)
+            else:
+                np.dot(test_X[start:start + chunk_size], weights, out=test_Y[start:start + chunk_size])
+        test_Y += bias
         return test_Y
 
     def __convergence(self):
         """
-        Check convergance of the model, use the difference in 
-        model parameters as criteria for convergence instead 
-        of minimization of loss function which is typically more costly 
-        to compute at each iteration of batchGD/SGD. 
+        Check convergance of the model, converged when the squared loss of an
+        epoch changed by less than the convergance factor relative to the loss of
+        the epoch before. The loss is summed from the residuals the gradients are
+        computed from, so it costs no extra pass over the training set.
+        For sgd it is the loss of each mini-batch before its update, too noisy for
+        that test, sgd converges when the loss did not improve on the best loss by
+        the sgd tolerance for patience epochs
         """
-        try:
-            self.old_model
-        except AttributeError, e:
+        if self.loss is None:
             return False
 
-        theta_converged = True
         self.iterations += 1
-
-        for index, old_theta in enumerate(self.old_model):
-            if np.abs(old_theta - self.model[index][0]) > self.convergance_factor:
-                theta_converged = False
-                break
+        if not np.isfinite(self.loss):
+            raise RuntimeError("the loss diverged, lower the learning rate")
 
         if self.iterations >= self.max_iter: return True
-        if theta_converged:
-            return True
-        else:
-            return False
+        if self.solver == 'sgd':
+            if self.best_loss is None or self.loss < (1 - self.sgd_tolerance) * self.best_loss:
+                self.best_loss, self.epochs_no_improvement = self.loss, 0
+            else:
+                self.epochs_no_improvement += 1
+            return self.epochs_no_improvement >= self.patience
+        if self.old_loss is None: return False
+        return np.abs(self.old_loss - self.loss) <= self.convergance_factor * self.old_loss
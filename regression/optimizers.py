@@ -0,0 +1,117 @@
+from __future__ import division
+import numpy as np
+
+
+class Optimizer(object):
+    """
+    A gradient descent optimizer, updates a parameter vector in place from its
+    gradient, the per parameter state of the optimizer is held in vectors of
+    the shape of the parameters, allocated on the first update
+    """
+
+    def __init__(self, learning_rate):
+        self.learning_rate = learning_rate
+        self.num_updates = 0
+
+    def update(self, params, gradient, indices=None):
+        """
+        take a descent step of the params in place
+        @param params   : numpy vector of the parameters
+        @param gradient : gradient of the loss with respect to params, or to
+                          params[indices] if indices are given
+        @param indices  : indices of the parameters with a non zero gradient, the
+                          other parameters and their state are not touched
+        """
+        self.num_updates += 1
+        self._step(params, gradient, slice(None) if indices is None else indices)
+
+    def _step(self, params, gradient, indices):
+        raise NotImplementedError
+
+    def _state(self, params):
+        return np.zeros(shape=params.shape, dtype=np.float64)
+
+
+class SGD(Optimizer):
+    """
+    plain stochastic gradient descent, params -= learning_rate * gradient
+    """
+
+    def _step(self, params, gradient, indices):
+        params[indices] -= self.learning_rate * gradient
+
+
+class Momentum(Optimizer):
+    """
+    gradient descent with momentum, the step is a decaying sum of the gradients
+    """
+
+    def __init__(self, learning_rate, momentum=0.9):
+        super(Momentum, self).__init__(learning_rate)
+        self.momentum = momentum
+        self.velocity = None
+
+    def _step(self, params, gradient, indices):
+        if self.velocity is None:
+            self.velocity = self._state(params)
+        velocity = self.momentum * self.velocity[indices] + self.learning_rate * gradient
+        self.velocity[indices] = velocity
+        params[indices] -= velocity
+
+
+class Adagrad(Optimizer):
+    """
+    Adagrad, the learning rate of each parameter is scaled down by the root of
+    the sum of its squared gradients so far
+    """
+
+    def __init__(self, learning_rate, epsilon=1e-08):
+        super(Adagrad, self).__init__(learning_rate)
+        self.epsilon = epsilon
+        self.cache = None
+
+    def _step(self, params, gradient, indices):
+        if self.cache is None:
+            self.cache = self._state(params)
+        cache = self.cache[indices] + gradient * gradient
+        self.cache[indices] = cache
+        params[indices] -= self.learning_rate * gradient / (np.sqrt(cache) + self.epsilon)
+
+
+class Adam(Optimizer):
+    """
+    Adam, steps along bias corrected moving averages of the gradients scaled by
+    the root of the moving averages of the squared gradients
+    """
+
+    def __init__(self, learning_rate, beta1=0.9, beta2=0.999, epsilon=1e-08):
+        super(Adam, self).__init__(learning_rate)
+        self.beta1, self.beta2 = beta1, beta2
+        self.epsilon = epsilon
+        self.first_moment, self.second_moment = None, None
+
+    def _step(self, params, gradient, indices):
+        if self.first_moment is None:
+            self.first_moment, self.second_moment = self._state(params), self._state(params)
+        first_moment = self.beta1 * self.first_moment[indices] + (1 - self.beta1) * gradient
+        second_moment = self.beta2 * self.second_moment[indices] + (1 - self.beta2) * gradient * gradient
+        self.first_moment[indices], self.second_moment[indices] = first_moment, second_moment
+
+        # the moments start at 0, correct their bias towards 0 over the first updates
+        step_size = self.learning_rate * np.sqrt(1 - self.beta2 ** self.num_updates) \
+                    / (1 - self.beta1 ** self.num_updates)
+        params[indices] -= step_size * first_moment / (np.sqrt(second_moment) + self.epsilon)
+
+
+OPTIMIZERS = {'sgd': SGD, 'momentum': Momentum, 'adagrad': Adagrad, 'adam': Adam}
+
+
+def get_optimizer(optimizer, learning_rate):
+    """
+    get an optimizer by name with the learning rate, an Optimizer instance is returned as is
+    """
+    if isinstance(optimizer, Optimizer):
+        return optimizer
+    if optimizer not in OPTIMIZERS:
+        raise RuntimeError("optimizer must be one of %s" % ", ".join(sorted(OPTIMIZERS)))
+    return OPTIMIZERS[optimizer](learning_rate)
@@ -0,0 +1,47 @@
+import json
+import os
+
+import numpy as np
+
+META_FILE = 'meta.json'
+
+
+def save_arrays(path, arrays, meta):
+    """
+    save a set of named numpy arrays and a json document of metadata to the
+    directory path, each array goes to its own .npy file so that it can be
+    memory mapped on load
+    :param path : directory to save to, created if it does not exist
+    :param arrays : dict of array name to numpy ndarray, None values are skipped
+    :param meta : json serializable dict of metadata
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    names = sorted(name for name, array in arrays.items() if array is not None)
+    for name in names:
+        np.save(os.path.join(path, name + '.npy'), arrays[name])
+
+    meta = dict(meta, arrays=names)
+    with open(os.path.join(path, META_FILE), 'w') as meta_file:
+        json.dump(meta, meta_file)
+
+
+def load_arrays(path, mmap_mode='r'):
+    """
+    load the arrays and the metadata saved by save_arrays
+    :param path : directory the arrays were saved to
+    :param mmap_mode : memory map mode of the arrays as in numpy.load, the
+                       default "r" maps the files read only so processes loading
+                       the same files share their pages, None reads them to memory
+    :return : (dict of array name to array, dict of metadata)
+    """
+    meta_path = os.path.join(path, META_FILE)
+    if not os.path.isfile(meta_path):
+        raise RuntimeError("no saved model found at :%s" % path)
+    with open(meta_path) as meta_file:
+        meta = json.load(meta_file)
+
+    arrays = {}
+    for name in meta.pop('arrays'):
+        arrays[name] = np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+    return arrays, meta